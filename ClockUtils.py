@@ -1,10 +1,13 @@
 
-import os, logging, fileinput, subprocess, re
+import os, logging, fileinput, subprocess, re, threading, time, math
 
+from array import array
 from datetime import datetime, timedelta
-from .Switch import switch
+from collections import namedtuple
 
-from . import is_a_cme, is_a_docker, docker_run
+from . import is_a_cme, is_a_docker, docker_run, ServiceUtils
+
+NTP_UNIT = 'ntp'
 
 def set_clock(newtime):
 	''' use the system 'date' command to set it
@@ -35,14 +38,18 @@ def check_ntp():
 	if not is_a_cme():
 		return True
 
-	cmd = ['systemctl', 'is-active', 'ntp']
+	poller = ntp_poller()
+	if poller is not None and poller.time is not None:
+		return poller.active
 
-	if is_a_docker():
-		result = docker_run(cmd)
-	else:
-		result = subprocess.run(cmd, stdout=subprocess.PIPE).stdout.decode().rstrip()
+	return _ntp_active()
 
-	return result.lower() == 'active'
+
+def _ntp_active(max_age=None):
+	try:
+		return ServiceUtils.is_active(NTP_UNIT, max_age)
+	except (OSError, ValueError):
+		return False
 
 
 def manage_clock(user_settings):
@@ -78,55 +85,461 @@ def manage_clock(user_settings):
 
 	if update_ntp or (new_use_ntp != current_ntp):
 
-		ntp_enable = ['systemctl', 'enable', 'ntp']
-		ntp_start = ['systemctl', 'start', 'ntp']
-
-		ntp_disable = ['systemctl', 'disable', 'ntp']
-		ntp_stop = ['systemctl', 'stop', 'ntp']
-
+		# each pair goes to the host in a single round trip (a running
+		# ntpd is restarted to pick up new servers)
 		if new_use_ntp:
 			logger.info("Starting NTP service.")
-
-			if is_a_docker():
-				docker_run(ntp_enable)
-				docker_run(ntp_start)
+			if update_ntp and current_ntp:
+				results = ServiceUtils.manage_units(enable=[ NTP_UNIT ], restart=[ NTP_UNIT ])
 			else:
-				subprocess.run(ntp_enable)
-				subprocess.run(ntp_start)
+				results = ServiceUtils.manage_units(enable=[ NTP_UNIT ], start=[ NTP_UNIT ])
 
 		else:
 			logger.info("Stopping NTP service.")
+			results = ServiceUtils.manage_units(stop=[ NTP_UNIT ], disable=[ NTP_UNIT ])
 
-			if is_a_docker():
-				docker_run(ntp_stop)
-				docker_run(ntp_disable)
-			else:
-				subprocess.run(ntp_stop)
-				subprocess.run(ntp_disable)
+		for status, output in results:
+			if status != 0:
+				logger.error("\tNTP service command failed ({0}): {1}".format(status, output))
+
+		# don't let a poller report the old state, not even until its
+		# thread wakes up
+		poller = ntp_poller()
+		if poller is not None:
+			try:
+				poller.poll()
+			except Exception:
+				logger.exception("NTP status poll failed")
+				poller.refresh()
+
+
+# ntpd peer status query
+NTPQ_CMD = ['ntpq', '-pn']
+
+# a peer line of NTPQ_CMD output, e.g.,
+# *192.168.1.10    .GPS.            1 u   37   64  377    0.512   -0.032   0.021
+_NTPQ_PEER = re.compile(
+	r'^(?P<tally>[ x.\-+#*o])(?P<remote>\S+)\s+(?P<refid>\S+)\s+(?P<st>\d+)\s+(?P<t>\S)\s+'
+	r'(?P<when>\S+)\s+(?P<poll>\S+)\s+(?P<reach>[0-7]+)\s+'
+	r'(?P<delay>\S+)\s+(?P<offset>\S+)\s+(?P<jitter>\S+)[ \t]*$', re.MULTILINE)
+
+# ntpq 'when' and 'poll' unit suffixes
+_UNITS = { 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60 }
+
+# tally: '*' system peer, 'o' pps peer, '+' candidate, '#' backup,
+# '-' outlier, 'x' falseticker, '.' excess, ' ' rejected.
+# when and poll are seconds (when is None if never polled), reach is
+# the 8-bit poll history, delay, offset and jitter are milliseconds.
+NtpPeer = namedtuple('NtpPeer', 'tally remote refid stratum type when poll reach delay offset jitter')
+
+
+def _seconds(value):
+	''' ntpq interval ('37', '12m', '3h', '2d' or '-') in seconds, or None.
+	'''
+	if value[-1] in _UNITS:
+		return int(value[:-1]) * _UNITS[value[-1]]
+
+	return None if value == '-' else int(value)
+
+
+def _float(value):
+	try:
+		return float(value)
+	except ValueError:
+		return None
+
+
+def parse_ntpq(ntpq_result):
+	''' Returns every peer (as NtpPeer) in the output of NTPQ_CMD.
+	'''
+	# skip the header lines
+	start = ntpq_result.find('===\n')
+	if start != -1:
+		ntpq_result = ntpq_result[start + 4:]
+
+	peers = []
+	for m in _NTPQ_PEER.finditer(ntpq_result):
+		try:
+			when, poll = _seconds(m.group('when')), _seconds(m.group('poll'))
+		except ValueError:
+			continue # not a peer line
+
+		peers.append(NtpPeer(m.group('tally'), m.group('remote'), m.group('refid'),
+			int(m.group('st')), m.group('t'), when, poll, int(m.group('reach'), 8),
+			_float(m.group('delay')), _float(m.group('offset')), _float(m.group('jitter'))))
+
+	return peers
+
+
+def sync_peer(peers):
+	''' Returns the peer the clock is synchronised to (or the first one if
+		none is), or None if there are no peers.
+	'''
+	for tally in '*o':
+		for peer in peers:
+			if peer.tally == tally:
+				return peer
+
+	return peers[0] if peers else None
+
+
+def peers_status(peers):
+	''' Returns the clock 'status' entry, [ last_request, last_success ],
+		of the sync peer.
+	'''
+	last_request, last_success = _poll_times(sync_peer(peers))
+
+	return [ last_request, last_success ]
+
+
+def ntp_status(ntpq_result):
+	''' Returns the clock 'status' entry from the output of NTPQ_CMD.
+	'''
+	return peers_status(parse_ntpq(ntpq_result))
+
+
+def _ntpq():
+	if is_a_docker():
+		return docker_run(NTPQ_CMD)
+
+	return subprocess.run(NTPQ_CMD, stdout=subprocess.PIPE).stdout.decode()
+
+
+# after the native client fails, ntpq is used for this long
+NATIVE_RETRY_s = 300
+
+_native_retry = 0
+
+def ntp_peers():
+	''' Returns the ntpd peers (as NtpPeer), queried directly over UDP (see
+		NtpClient), or through NTPQ_CMD if ntpd can't be reached that way.
+	'''
+	global _native_retry
+
+	from . import NtpClient
+
+	peers = None
+
+	if time.monotonic() >= _native_retry:
+		try:
+			peers = NtpClient.peers()
+		except (OSError, NtpClient.NtpError) as e:
+			logging.getLogger(__name__).info("NTP control query failed ({0}), using ntpq".format(e))
+			_native_retry = time.monotonic() + NATIVE_RETRY_s
+
+	if peers is None:
+		peers = parse_ntpq(_ntpq())
+
+	clock_history.record(peers)
+
+	return peers
 
 
 def refresh_time(clock_settings):
 	''' Update the current clock settings with values from the system.
 
+		The NTP status comes from the NtpPoller if one is running.  Returns
+		the age (seconds) of the NTP status, 0 if it was just queried.
+
 		Does not update settings if not a cme device.
 	'''
+	age = 0
+
 	# if useNTP, we'll update the NTP status
 	if clock_settings['ntp'] and is_a_cme():
-		cmd = ['ntpq', '-pn']
+		poller = ntp_poller()
 
-		if is_a_docker():
-			result = docker_run(cmd)
+		if poller is not None and poller.time is not None:
+			clock_settings['status'] = list(poller.status)
+			age = poller.age
 		else:
-			result = subprocess.run(cmd, stdout=subprocess.PIPE).stdout.decode()
-
-		last_request, last_success = __parse_ntpq(result)
-		clock_settings['status'] = [ last_request, last_success ]
+			clock_settings['status'] = peers_status(ntp_peers())
 	else:
 		clock_settings['status'] = [ '-', '-' ]
 
 	# read ntp servers from /etc/ntp.conf
 	clock_settings['servers'] = ntp_servers()
 
+	return age
+
+
+class NtpPoller(object):
+	''' Queries the NTP service state and peers in the background, on the
+		ntp poll interval of the sync peer (bounded by MIN_s and MAX_s), so
+		check_ntp() and refresh_time() answer from memory.
+
+			poller = start_ntp_poller()
+			...
+			poller.age # seconds since the last query
+
+		Readers see active, status, peers and time (monotonic, None until
+		the first query) from the same query.
+	'''
+	MIN_s = 16
+	MAX_s = 1024
+	DEFAULT_s = 64
+
+	def __init__(self):
+		self.active = None
+		self.status = [ '-', '-' ]
+		self.peers = []
+		self.time = None
+
+		self._started = None # start of the query the values are from
+		self._lock = threading.Lock()
+		self._wake = threading.Event()
+		self._stop = False
+		self._thread = None
+
+	@property
+	def age(self):
+		return None if self.time is None else time.monotonic() - self.time
+
+	def start(self):
+		if self._thread is None:
+			self._stop = False
+			self._thread = threading.Thread(target=self._run, name='NtpPoller', daemon=True)
+			self._thread.start()
+
+		return self
+
+	def stop(self):
+		if self._thread is not None:
+			self._stop = True
+			self._wake.set()
+			self._thread.join()
+			self._thread = None
+
+	def refresh(self):
+		''' Query again now (e.g., after the service was changed).
+		'''
+		self._wake.set()
+
+	def poll(self):
+		''' Query the service state and peers once.
+		'''
+		started = time.monotonic()
+
+		active = _ntp_active(max_age=0)
+		peers = ntp_peers() if active else []
+		status = peers_status(peers)
+
+		# swap in the new values together, unless a query started since
+		# (e.g., by manage_clock) has already done so
+		with self._lock:
+			if self._started is None or started >= self._started:
+				self._started = started
+				self.active, self.status, self.peers, self.time = active, status, peers, time.monotonic()
+
+	def interval(self):
+		peer = sync_peer(self.peers)
+		poll = peer.poll if peer is not None and peer.poll else self.DEFAULT_s
+
+		return min(max(poll, self.MIN_s), self.MAX_s)
+
+	def _run(self):
+		logger = logging.getLogger(__name__)
+
+		while not self._stop:
+			try:
+				self.poll()
+			except Exception:
+				logger.exception("NTP status poll failed")
+
+			self._wake.wait(self.interval())
+			self._wake.clear()
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+def start_ntp_poller():
+	''' Start (once) and return the NtpPoller used by check_ntp() and
+		refresh_time().  Does nothing and returns None if not a cme device.
+	'''
+	global _poller
+
+	if not is_a_cme():
+		return None
+
+	with _poller_lock:
+		if _poller is None:
+			_poller = NtpPoller().start()
+
+		return _poller
+
+
+def stop_ntp_poller():
+	global _poller
+
+	with _poller_lock:
+		poller, _poller = _poller, None
+
+	if poller is not None:
+		poller.stop()
+
+
+def ntp_poller():
+	''' Returns the running NtpPoller, or None.
+	'''
+	return _poller
+
+
+class PeerHistory(object):
+	''' The last size samples of a peer's offset, jitter, delay (ms) and
+		reach, in fixed arrays used as a ring.  Running sums are kept as
+		samples come and go, so stats() is O(1): the mean and stdev of
+		each value and the offset drift (least squares slope over time,
+		in ppm).  The sums are rebuilt from the ring every size samples
+		so rounding errors don't accumulate.
+	'''
+	FIELDS = ('offset', 'jitter', 'delay', 'reach')
+
+	def __init__(self, size=256):
+		self.size = size
+		self.count = 0
+		self.next = 0
+		self.base = None # time of the first sample (keeps t small)
+
+		self.t = array('d', bytes(8 * size))
+		self.values = { f: array('d', bytes(8 * size)) for f in self.FIELDS }
+
+		self._reset_sums()
+		self._added = 0
+
+	def _reset_sums(self):
+		self.sums = dict.fromkeys(self.FIELDS, 0.0)
+		self.squares = dict.fromkeys(self.FIELDS, 0.0)
+		self.st = self.stt = self.sty = 0.0
+
+	def _account(self, i, sign):
+		t = self.t[i]
+		self.st += sign * t
+		self.stt += sign * t * t
+		self.sty += sign * t * self.values['offset'][i]
+
+		for f in self.FIELDS:
+			v = self.values[f][i]
+			self.sums[f] += sign * v
+			self.squares[f] += sign * v * v
+
+	def add(self, t, offset, jitter, delay, reach):
+		''' Add a sample taken at t (time.monotonic() seconds).
+		'''
+		if self.base is None:
+			self.base = t
+
+		i = self.next
+		if self.count == self.size:
+			self._account(i, -1)
+		else:
+			self.count += 1
+
+		self.t[i] = t - self.base
+		for f, v in zip(self.FIELDS, (offset, jitter, delay, reach)):
+			self.values[f][i] = v
+
+		self._account(i, 1)
+		self.next = (i + 1) % self.size
+
+		self._added += 1
+		if self._added % self.size == 0:
+			self._reset_sums()
+			for j in range(self.count):
+				self._account(j, 1)
+
+	def last(self, field):
+		return self.values[field][self.next - 1] if self.count else None
+
+	def mean(self, field):
+		return self.sums[field] / self.count if self.count else None
+
+	def stdev(self, field):
+		if self.count < 2:
+			return None
+
+		n = self.count
+		return math.sqrt(max(self.squares[field] - self.sums[field] ** 2 / n, 0.0) / (n - 1))
+
+	def drift(self):
+		''' Offset change rate in ppm (ms of offset per second is 1000 ppm),
+			or None with fewer than two samples.
+		'''
+		n = self.count
+		d = n * self.stt - self.st ** 2
+		if n < 2 or d <= 0:
+			return None
+
+		return (n * self.sty - self.st * self.sums['offset']) / d * 1000
+
+	def samples(self):
+		''' The samples, oldest first, as (t, offset, jitter, delay, reach).
+		'''
+		start = self.next if self.count == self.size else 0
+		order = [ (start + k) % self.size for k in range(self.count) ]
+
+		return [ (self.t[i] + self.base,) + tuple(self.values[f][i] for f in self.FIELDS) for i in order ]
+
+	def stats(self):
+		result = { 'count': self.count, 'drift_ppm': self.drift() }
+
+		for f in ('offset', 'jitter', 'delay'):
+			result[f] = { 'last': self.last(f), 'mean': self.mean(f), 'stdev': self.stdev(f) }
+
+		result['reach'] = int(self.last('reach')) if self.count else None
+
+		return result
+
+
+class ClockHistory(object):
+	''' A PeerHistory per peer (by remote address), fed by ntp_peers().
+		A peer is only sampled when ntpd has polled it again since its
+		last sample, however often the peers are read.
+	'''
+	def __init__(self, size=256):
+		self.size = size
+		self.peers = {}
+		self._measured = {} # remote -> time of the last sampled measurement
+		self._lock = threading.Lock()
+
+	def record(self, peers, t=None):
+		t = time.monotonic() if t is None else t
+
+		with self._lock:
+			for peer in peers:
+				if peer.offset is None or peer.when is None:
+					continue # not (yet) polled
+
+				# when (seconds since the last poll) is coarse (e.g., "5m"),
+				# so only a move of half a poll interval is a new measurement
+				measured = t - peer.when
+				last = self._measured.get(peer.remote)
+				if last is not None and measured - last < max(peer.poll or 0, 2) / 2:
+					continue
+
+				self._measured[peer.remote] = measured
+
+				history = self.peers.get(peer.remote)
+				if history is None:
+					history = self.peers[peer.remote] = PeerHistory(self.size)
+
+				history.add(measured, peer.offset, peer.jitter or 0.0, peer.delay or 0.0, peer.reach)
+
+	def snapshot(self):
+		''' Returns the PeerHistory.stats() of each peer, keyed by remote.
+		'''
+		with self._lock:
+			return { remote: h.stats() for remote, h in self.peers.items() }
+
+	def clear(self):
+		with self._lock:
+			self.peers.clear()
+			self._measured.clear()
+
+
+# offset/jitter/delay history of the peers, see clock_history.snapshot()
+clock_history = ClockHistory()
+
 
 def ntp_servers(new_servers=None):
 	''' 
@@ -138,11 +551,22 @@ def ntp_servers(new_servers=None):
 
 		No changes are made if not a cme device.
 	'''
+	global _servers_cache
+
 	ntp_conf = "/etc/ntp.conf"
 	servers = new_servers or []
 	servers_added = False
 	writing = new_servers is not None and is_a_cme()
 
+	# reads are answered from the cache while ntp.conf is unchanged
+	if not writing:
+		st = os.stat(ntp_conf)
+		mtime = (st.st_mtime_ns, st.st_size)
+		cached = _servers_cache
+
+		if cached is not None and cached[0] == mtime:
+			return list(cached[1])
+
 	# the fileinput hijacks std.output, so the prints below go to the
 	# file, not the console.
 	with fileinput.input(files=(ntp_conf), inplace=writing) as f:
@@ -179,106 +603,31 @@ def ntp_servers(new_servers=None):
 				f.write("server {0} iburst\n".format(s))
 			f.write('\n')
 
-	return servers
+	_servers_cache = None if writing else (mtime, list(servers))
 
+	return servers
 
-def __parse_ntpq(ntpq_result):
-	''' Parse the ntpq output for NTP status
-		good referece:	http://www.linuxjournal.com/article/6812
-	'''
 
-	# remove header lines
-	start = ntpq_result.find('===\n')
+# ((ntp.conf mtime, size), servers) of the last ntp_servers() read
+_servers_cache = None
 
-	if not start:
-		return "-", "-"
 
-	servers = ntpq_result[start+4:]
-
-	# find NTP primary server (has * at beginning)
-	exp = ("\*((?P<remote>\S+)\s+)"
-		   "((?P<refid>\S+)\s+)"
-		   "((?P<st>\S+)\s+)"
-		   "((?P<t>\S+)\s+)"
-		   "((?P<when>\S+)\s+)"
-		   "((?P<poll>\S+)\s+)"
-		   "((?P<reach>\S+)\s+)"
-		   "((?P<delay>\S+)\s+)"
-		   "((?P<offset>\S+)\s+)"
-		   "((?P<jitter>\S+)\s+)")
-
-	regex = re.compile(exp, re.MULTILINE)
-	r = regex.search(servers)
-
-	# did we find primary server?
-	if not r:
-		# we'll search again w/o "*" at beginning
-		exp = (" ((?P<remote>\S+)\s+)"
-			   "((?P<refid>\S+)\s+)"
-			   "((?P<st>\S+)\s+)"
-			   "((?P<t>\S+)\s+)"
-			   "((?P<when>\S+)\s+)"
-			   "((?P<poll>\S+)\s+)"
-			   "((?P<reach>\S+)\s+)"
-			   "((?P<delay>\S+)\s+)"
-			   "((?P<offset>\S+)\s+)"
-			   "((?P<jitter>\S+)\s+)")
-
-		regex = re.compile(exp, re.MULTILINE)
-		r = regex.search(servers)
-
-	if not r:
+def _poll_times(peer):
+	''' Returns the last polling and last successful polling times of a peer.
+		good referece:	http://www.linuxjournal.com/article/6812
+	'''
+	if peer is None or peer.when is None:
 		return "-", "-"
 
-	data = r.groupdict()
+	now = datetime.utcnow()
 
 	# create a timestamp for last polling time
-	# this integer can have units: m = minutes, h = hours, d = days
-	units = ['m', 'h', 'd']
-	last_poll = data['when']
-	last_poll_unit = list(last_poll)[-1]
-
-	if "-" in list(last_poll):
-		return "-", "-"
-
-	# is there a unit character?
-	if last_poll_unit in units:
-		for case in switch(last_poll_unit):
-			if case('m'): # minutes
-				last_poll_s = int(last_poll[:-1]) * 60
-				break
-			if case('h'): # hours
-				last_poll_s = int(last_poll[:-1]) * 60 * 60
-				break
-			if case('d'): # days
-				last_poll_s = int(last_poll[:-1]) * 24 * 60 * 60
-
-	else:
-		last_poll_s = int(last_poll)
-
-	last_poll_time = (datetime.utcnow() - timedelta(seconds=last_poll_s)).isoformat()
-
-
-	# TODO: we were getting an error parsing 'reach'.  This was a quick fix patch,
-	# but we really need to parse the ntpq results better.
-	# how often are we polling
-	try:
-		poll_s = int(data['poll'])
-	except:
-		poll_s = 64
-
-	# look at the "reach" to calculate a last success time
-	try:
-		reach = int(data['reach'], 8) # convert from Octal representation
-	except:
-		reach = int('377', 8)
-	# TODO END: Quick fix
-
+	last_poll_time = (now - timedelta(seconds=peer.when)).isoformat()
 
 	# edge cases
-	if reach == 0:
+	if peer.reach == 0:
 		last_success_time = "-"
-	elif reach == 255:
+	elif peer.reach == 255:
 		last_success_time = last_poll_time
 
 	# Else the "reach" field is an 8-bit set that holds 0's for unsuccessful
@@ -292,8 +641,8 @@ def __parse_ntpq(ntpq_result):
 	# We use the "poll" field to tell how many seconds between polling then
 	# use the first non-zero bit position as the multiplier.
 	else:
-		last_success_s = (last_poll_s + __lowestSet(reach) * poll_s)
-		last_success_time = (datetime.utcnow() - timedelta(seconds=(last_success_s))).isoformat() + 'Z'
+		last_success_s = (peer.when + __lowestSet(peer.reach) * (peer.poll or 64))
+		last_success_time = (now - timedelta(seconds=(last_success_s))).isoformat() + 'Z'
 
 	return last_poll_time, last_success_time
 
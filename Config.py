@@ -16,9 +16,28 @@
 	but cached in the USERDATA folder in a file called 'settings.json'.
 	Currently, only the Cme program is responsible for providing
 	access to the user-configurable settings.
+
+	Importing this file has no side effects.  Values that need the
+	file system or platform (e.g., INFO.VERSION) are resolved on first
+	access and cached, and programs should call ensure_dirs() at startup
+	to create the USERDATA folders.
 '''
 
-import os, uuid, platform, json, datetime
+import os
+
+
+class _lazy(object):
+	''' Section attribute computed by the decorated function on first
+		access, then cached on the section class in place of itself.
+	'''
+	def __init__(self, fget):
+		self.fget = fget
+		self.name = fget.__name__
+
+	def __get__(self, obj, owner):
+		value = self.fget(owner)
+		setattr(owner, self.name, value)
+		return value
 
 
 # Temperature units enumeration
@@ -53,6 +72,10 @@ class PATHS:
 	# Alarms are stored here by the Cme-hw and read by the API layer
 	ALARMS_DB = os.path.join(USERDATA, 'alarms.db')
 
+	# Unbounded key/value stores (see common/DictPersistSQLite.py) are kept
+	# here, one table per store
+	STORE_DB = os.path.join(USERDATA, 'store.db')
+
 	# uploads go to temp folder here
 	UPLOADS = os.path.join(USERDATA, 'tmp')
 
@@ -86,10 +109,16 @@ class PATHS:
 	POWEROFF_FILE = os.path.join(USERDATA, '.poweroff')
 
 
-	# create USERDATA folders if they don't yet exist
-	for p in [ UPLOADS, UPDATE, LOGDIR, CHDIR ]:
-		if not os.path.exists(p):
-			os.makedirs(p)
+	# USERDATA folders created by ensure_dirs()
+	DIRS = [ UPLOADS, UPDATE, LOGDIR, CHDIR ]
+
+
+
+def ensure_dirs():
+	''' Create the USERDATA folders if they don't yet exist.
+	'''
+	for p in PATHS.DIRS:
+		os.makedirs(p, exist_ok=True)
 
 
 
@@ -97,47 +126,62 @@ class INFO:
 	''' Holds general system information and application package version.
 	'''
 	DEBUG = True
-	HOSTNAME = platform.node()
-	SYSTEM = platform.uname()
+
+	@_lazy
+	def HOSTNAME(cls):
+		import platform
+		return platform.node()
+
+	@_lazy
+	def SYSTEM(cls):
+		import platform
+		return platform.uname()
 
 	# Each CME package uses a simple VERSION file
 	# to hold its revision.  The file should be
 	# found in the package root folder.
-	VERSION = 'x.x.x'
-
+	#
 	# It's a complete failure if VERSION cannot be read, this
-	# will fail launching every package if it errors here.
-	with open(PATHS.VERSION_FILE, "r") as f:
-		VERSION = f.readline().strip()
+	# will fail every package when it first reads the VERSION.
+	@_lazy
+	def VERSION(cls):
+		with open(PATHS.VERSION_FILE, "r") as f:
+			return f.readline().strip()
 
 	# CME Device info is 'hard-coded' into the device.json
 	# read-only file in the USERDATA folder.  It may not exist
 	# if the Cme device has not yet gone through production so
 	# we don't want to fail here.
-	DEVICE = {
-		'host': {
-			'modelNumber': '', 
-			'serialNumber': '',
-			'dateCode': ''
-		},
-		'cme': {
-			'productName': 'TracVision',
-			'modelNumber': 'UNKNOWN', 
-			'serialNumber': '00000000',
-			'dateCode': '{:%Y%m%d}'.format(datetime.datetime.now()),
-			'unlocked': True
+	@_lazy
+	def DEVICE(cls):
+		import json, datetime
+
+		device = {
+			'host': {
+				'modelNumber': '', 
+				'serialNumber': '',
+				'dateCode': ''
+			},
+			'cme': {
+				'productName': 'TracVision',
+				'modelNumber': 'UNKNOWN', 
+				'serialNumber': '00000000',
+				'dateCode': '{:%Y%m%d}'.format(datetime.datetime.now()),
+				'unlocked': True
+			}
 		}
-	}
 
-	try:
-		with open(PATHS.DEVICE_FILE, "r") as f:
-			DEVICE = json.load(f)
-	except:
-		pass
+		try:
+			with open(PATHS.DEVICE_FILE, "r") as f:
+				device = json.load(f)
+		except:
+			pass
+
+		# Set the Cme device version here whether we loaded it from device.json
+		# or are just using defaults.
+		device['cme'].setdefault('firmware', cls.VERSION)
 
-	# Set the Cme device version here whether we loaded it from device.json
-	# or are just using defaults.
-	DEVICE['cme'].setdefault('firmware', VERSION)
+		return device
 
 
 
@@ -162,8 +206,10 @@ class RECOVERY:
 		contains the API) will launch as "recovery mode".
 	'''
 	# recovery mode if we're not running inside a docker container
-	from . import is_a_docker
-	RECOVERY_MODE = not is_a_docker()
+	@_lazy
+	def RECOVERY_MODE(cls):
+		from . import is_a_docker
+		return not is_a_docker()
 
 	# How long to hold reset button?
 	RESET_REBOOT_SECONDS = 3 # simple reboot if held < this time
@@ -179,6 +225,13 @@ class LOGGING:
 	LOGBYTES = 1024 * 50
 	LOGCOUNT = 1
 
+	# Compressed rotation (Logging config 'COMPRESS'): rotated logs are
+	# gzipped, so many more of them fit within the total LOGBUDGET for
+	# PATHS.LOGDIR.  Writes are buffered for up to FLUSH_INTERVAL_s.
+	COMPRESSED_LOGCOUNT = 20
+	LOGBUDGET = 1024 * 1024 * 4
+	FLUSH_INTERVAL_s = 1.0
+
 	BOOTLOG = os.path.join(PATHS.LOGDIR, 'cme-boot.log')
 	APILOG = os.path.join(PATHS.LOGDIR, 'cme-api.log')
 	HWLOG = os.path.join(PATHS.LOGDIR, 'cme-hw.log')
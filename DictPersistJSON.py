@@ -1,47 +1,756 @@
-import os, fcntl, tempfile, json
+import os, tempfile, json, marshal, threading, time, atexit, logging
+from contextlib import contextmanager
 from .LockedOpen import LockedOpen
 
+try:
+	import msgpack
+except ImportError:
+	msgpack = None
+
+
+def _plain(value):
+	''' Returns value with tracked (or other subclassed) dicts and lists
+		converted to the builtin types the binary encoders require.
+	'''
+	if isinstance(value, dict):
+		return { k: _plain(v) for k, v in value.items() }
+
+	if isinstance(value, (list, tuple)):
+		return [ _plain(v) for v in value ]
+
+	return value
+
+
+class Serializer(object):
+	''' File format for a DictPersistJSON.  Binary formats start with a
+		magic prefix so the format of an existing file can be detected
+		(and the file migrated) when it is loaded.
+	'''
+	def __init__(self, name, dumps, loads, magic=b''):
+		self.name = name
+		self.magic = magic
+		self._dumps = dumps
+		self._loads = loads
+
+	def dumps(self, data):
+		return self.magic + self._dumps(data)
+
+	def loads(self, raw):
+		return self._loads(raw[len(self.magic):])
+
+
+SERIALIZERS = {
+	# human readable (the original format, handy for debugging)
+	'json': Serializer('json',
+		lambda d: json.dumps(d, indent="\t").encode(),
+		lambda b: json.loads(b.decode())),
+
+	# smaller and faster to write
+	'json-compact': Serializer('json-compact',
+		lambda d: json.dumps(d, separators=(',', ':')).encode(),
+		lambda b: json.loads(b.decode())),
+
+	# fastest in CPython, but tied to the Python version that wrote it
+	'marshal': Serializer('marshal',
+		lambda d: marshal.dumps(_plain(d)),
+		marshal.loads,
+		magic=b'\x00DPJmarshal\n')
+}
+
+if msgpack is not None:
+	SERIALIZERS['msgpack'] = Serializer('msgpack',
+		lambda d: msgpack.packb(_plain(d), use_bin_type=True),
+		lambda b: msgpack.unpackb(b, raw=False),
+		magic=b'\x00DPJmsgpack\n')
+
+
+def _detect(raw):
+	''' Returns the Serializer that wrote raw file contents (JSON files
+		have no magic prefix).
+	'''
+	for serializer in SERIALIZERS.values():
+		if serializer.magic and raw.startswith(serializer.magic):
+			return serializer
+
+	return SERIALIZERS['json']
+
+def _canonical(value):
+	''' Compact, key-ordered JSON used to tell whether a value changed.
+	'''
+	return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def _track(value, root, path):
+	''' Returns value with its dicts and lists (recursively) replaced by
+		tracked copies that report changes to root at their key path.
+	'''
+	if isinstance(value, (_TrackedDict, _TrackedList)) and value._root is root and value._path == path:
+		return value
+
+	if isinstance(value, dict):
+		return _TrackedDict(value, root, path)
+
+	if isinstance(value, list):
+		return _TrackedList(value, root, path)
+
+	return value
+
+
+def _rebind(old, new, root, path):
+	''' Returns the reloaded value new for path, reusing the tracked
+		containers of old (updated in place) where the types still match,
+		so references held by callers keep reporting to root.
+	'''
+	if isinstance(old, _TrackedDict) and isinstance(new, dict) and old._root is root:
+		for k in [ k for k in old if k not in new ]:
+			_detach(dict.pop(old, k))
+
+		for k, v in new.items():
+			dict.__setitem__(old, k, _rebind(dict.get(old, k), v, root, path + (k,)))
+
+		return old
+
+	if isinstance(old, _TrackedList) and isinstance(new, list) and old._root is root:
+		for v in list.__getitem__(old, slice(len(new), None)):
+			_detach(v)
+
+		items = [ _rebind(list.__getitem__(old, i) if i < len(old) else None, v, root, path + (i,))
+			for i, v in enumerate(new) ]
+		list.__setitem__(old, slice(None), items)
+
+		return old
+
+	_detach(old)
+	return _track(new, root, path)
+
+
+def _detach(value):
+	''' Disconnect a tracked value that is no longer part of its root (its
+		key was deleted or replaced on a reload).  Changes made to it are
+		not persisted, and are logged as such.
+	'''
+	if isinstance(value, (_TrackedDict, _TrackedList)):
+		if value._root is not None:
+			value._detached = value._root.filename
+
+		value._root = None
+
+		for v in (value.values() if isinstance(value, dict) else value):
+			_detach(v)
+
+
+def _lost(value, path):
+	if value._detached:
+		logging.getLogger(__name__).warning("Change to {0} at {1} not saved: the value was replaced "
+			"when the file was reloaded".format(value._detached, list(path)))
+
+
+class _TrackedDict(dict):
+	''' A dict value (at any depth) of a DictPersistJSON.  Changes made to
+		it are reported to the root so they are persisted.
+	'''
+	_detached = None # filename of the root it was detached from
+
+	def __init__(self, data=(), root=None, path=()):
+		self._root = root
+		self._path = path
+		dict.__init__(self)
+		for k, v in dict(data).items():
+			dict.__setitem__(self, k, _track(v, root, path + (k,)))
+
+	def _touch(self, key=None):
+		path = self._path if key is None else self._path + (key,)
+
+		if self._root is not None:
+			self._root._touched(path)
+		else:
+			_lost(self, path)
+
+	def __reduce_ex__(self, protocol):
+		# copies and pickles are plain dicts
+		return (dict, (dict(self),))
+
+	def __setitem__(self, key, val):
+		dict.__setitem__(self, key, _track(val, self._root, self._path + (key,)))
+		self._touch(key)
+
+	def __delitem__(self, key):
+		dict.__delitem__(self, key)
+		self._touch(key)
+
+	def update(self, *args, **kwargs):
+		for k, v in dict(*args, **kwargs).items():
+			dict.__setitem__(self, k, _track(v, self._root, self._path + (k,)))
+		self._touch()
+
+	def setdefault(self, key, default=None):
+		if key not in self:
+			self[key] = default
+		return dict.__getitem__(self, key)
+
+	def pop(self, key, *args):
+		present = key in self
+		value = dict.pop(self, key, *args)
+		if present:
+			self._touch(key)
+		return value
+
+	def popitem(self):
+		item = dict.popitem(self)
+		self._touch(item[0])
+		return item
+
+	def clear(self):
+		dict.clear(self)
+		self._touch()
+
+
+class _TrackedList(list):
+	''' A list value (at any depth) of a DictPersistJSON.  Changes made to
+		it are reported to the root so they are persisted.
+	'''
+	_detached = None
+
+	def __init__(self, data=(), root=None, path=()):
+		self._root = root
+		self._path = path
+		list.__init__(self, [ _track(v, root, path + (i,)) for i, v in enumerate(data) ])
+
+	def _touch(self):
+		if self._root is not None:
+			self._root._touched(self._path)
+		else:
+			_lost(self, self._path)
+
+	def __reduce_ex__(self, protocol):
+		return (list, (list(self),))
+
+	def _wrap(self, values, start=0):
+		return [ _track(v, self._root, self._path + (i,)) for i, v in enumerate(values, start) ]
+
+	def __setitem__(self, index, val):
+		if isinstance(index, slice):
+			list.__setitem__(self, index, self._wrap(val))
+		else:
+			list.__setitem__(self, index, _track(val, self._root, self._path + (index,)))
+		self._touch()
+
+	def __delitem__(self, index):
+		list.__delitem__(self, index)
+		self._touch()
+
+	def __iadd__(self, values):
+		self.extend(values)
+		return self
+
+	def append(self, val):
+		list.append(self, _track(val, self._root, self._path + (len(self),)))
+		self._touch()
+
+	def extend(self, values):
+		list.extend(self, self._wrap(values, len(self)))
+		self._touch()
+
+	def insert(self, index, val):
+		list.insert(self, index, _track(val, self._root, self._path + (index,)))
+		self._touch()
+
+	def pop(self, *args):
+		value = list.pop(self, *args)
+		self._touch()
+		return value
+
+	def remove(self, val):
+		list.remove(self, val)
+		self._touch()
+
+	def clear(self):
+		list.clear(self)
+		self._touch()
+
+	def sort(self, *args, **kwargs):
+		list.sort(self, *args, **kwargs)
+		self._touch()
+
+	def reverse(self):
+		list.reverse(self)
+		self._touch()
+
+
 class DictPersistJSON(dict):
+	''' A dict that saves itself to a JSON file whenever it is changed.
 
-	def __init__(self, filename, *args, **kwargs):
+		Several changes can be merged into a single write of the file:
+
+			with settings.transaction():
+				settings['clock'] = clock
+				settings['network'] = network
+
+		or, with flush_interval (seconds) set, every change is deferred to a
+		background thread that writes the file once no further changes have
+		been made for flush_interval (and at most MAX_DEFER_INTERVALS of
+		them after the first unsaved change).  Call flush() to write any
+		pending changes now, or close() before discarding the dict.
+
+		With journal=True, changes are appended to a journal file (the
+		filename + '.journal') as one compact JSON record per changed key
+		rather than rewriting the whole file.  The journal is replayed on
+		top of the file when loaded, and once it grows past journal_limit
+		bytes a background thread compacts it into a new file.
+
+		A write is skipped for keys whose value is in fact unchanged.  Only
+		top-level assignments are saved by default: nested values are held
+		as given, so settings['clock']['status'] = ... changes the dict in
+		memory only (handy for volatile status updated on every request).
+		With track=True, nested dicts and lists are tracked as well, so
+		settings['clock']['ntp'] = False is persisted like a top-level
+		change.  Tracked values are COPIED into tracked containers when
+		stored: keep using settings['clock'], not the dict that was
+		assigned, as later changes to that one are not seen.  The key paths
+		changed since the last write are available from changes().
+
+		serializer selects the file format from SERIALIZERS: 'json' (the
+		default, tab indented), 'json-compact', 'marshal' or, if installed,
+		'msgpack'.  Files are read in whatever format they were written in,
+		so changing the serializer migrates the file on its next write.
+
+		With coherent=True, reads first check (with a stat) whether another
+		process has changed the file or journal and, only if it has, reload
+		it under a shared lock.  Local changes not yet written are kept.
+		With track=True, nested values callers already hold are updated in
+		place by the reload; one whose key is gone (or is no longer a dict or list) is
+		detached, and changes to it are logged rather than saved.
+	'''
+	MAX_DEFER_INTERVALS = 5
+	JOURNAL_LIMIT = 64 * 1024
+
+	def __init__(self, filename, *args, flush_interval=None, journal=False, journal_limit=None,
+			coherent=False, serializer='json', track=False, **kwargs):
 		self.filename = filename
+		self.track = track
+		self.serializer = SERIALIZERS[serializer]
+		self.coherent = coherent
+		self.flush_interval = flush_interval
+		self.journal = filename + '.journal' if journal else None
+		self.journal_limit = journal_limit or self.JOURNAL_LIMIT
+
+		self._lock = threading.RLock()
+		self._wakeup = threading.Condition(self._lock)
+		self._depth = 0 # transaction nesting level
+		self._dirty = set() # keys changed since the last write
+		self._paths = set() # key paths changed since the last write
+		self._sections = {} # canonical JSON of each key as last written
+		self._deadline = None # deferred write due (time.monotonic())
+		self._first_change = None
+		self._flusher = None
+		self._closed = False
+		self._compactor = None
+		self._compact_lock = threading.Lock()
+		self._stat = None # file signature when last read or written
+
 		self._update(*args, **kwargs) # set from args
 		self._load() # overwrite loaded items with file items
 		self._dump() # save result to file
+		self._snapshot()
 
 	def _load(self):
+		self._stat = self._signature()
+		self._update(self._read())
+
+	def _read(self):
+		''' Returns the file (and journal) contents, read under a shared lock.
+		'''
+		data = {}
+
 		if os.path.isfile(self.filename) and os.path.getsize(self.filename) > 0:
-			with open(self.filename, 'r') as fh:
-				self._update(json.load(fh))
+			with LockedOpen(self.filename, 'rb', shared=True) as fh:
+				raw = fh.read()
+
+			data = _detect(raw).loads(raw)
+
+		if self.journal:
+			# a journal left by an unfinished compaction comes first
+			for journal in (self.journal + '.old', self.journal):
+				self._replay(journal, data)
+
+		return data
+
+	def _signature(self):
+		''' Cheap file identity used to detect changes by other processes.
+		'''
+		paths = [ self.filename ]
+		if self.journal:
+			paths += [ self.journal + '.old', self.journal ]
+
+		signature = []
+		for path in paths:
+			try:
+				st = os.stat(path)
+				signature.append((st.st_mtime_ns, st.st_ino, st.st_size))
+			except OSError:
+				signature.append(None)
+
+		return tuple(signature)
+
+	def _refresh(self):
+		''' Reload from the file if another process has changed it.
+		'''
+		if not self.coherent or self._dirty or self._depth:
+			return
+
+		if self._signature() == self._stat:
+			return
+
+		with self._lock:
+			if self._dirty or self._depth:
+				return
+
+			self._stat = self._signature()
+			self._reload()
+
+	def _reload(self):
+		''' Replace the contents with those of the file.
+		'''
+		data = self._read()
+
+		for k in [ k for k in dict.keys(self) if k not in data ]:
+			self._unload(k)
+
+		for k, v in data.items():
+			self._reload_key(k, v)
+
+		self._snapshot()
+
+	def _reload_key(self, key, value):
+		# reuse the tracked containers callers may hold
+		if self.track:
+			value = _rebind(dict.get(self, key), value, self, (key,))
+
+		dict.__setitem__(self, key, value)
+
+	def _unload(self, key):
+		_detach(dict.pop(self, key, None))
+
+	def _snapshot(self):
+		self._sections = { k: _canonical(v) for k, v in dict.items(self) }
+
+	def _diff(self, keys):
+		''' Returns the keys whose values differ from those last written,
+			and their new sections (None if deleted) to record once written.
+		'''
+		changed = {}
+		for k in keys:
+			section = _canonical(dict.__getitem__(self, k)) if dict.__contains__(self, k) else None
+
+			if section != self._sections.get(k):
+				changed[k] = section
+
+		return changed
+
+	def _written(self, changed):
+		''' Record the sections from _diff() as written.
+		'''
+		for k, section in changed.items():
+			if section is None:
+				self._sections.pop(k, None)
+			else:
+				self._sections[k] = section
 
 	def _dump(self):
+		self._write(self.serializer.dumps(dict.copy(self)))
+
+		# the file now holds everything journaled so far
+		if self.journal:
+			for journal in (self.journal + '.old', self.journal):
+				if os.path.exists(journal):
+					os.remove(journal)
+
+	def _write(self, raw):
 		with LockedOpen(self.filename, 'a') as fh:
-			with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.filename), delete=False) as tf:
-				json.dump(self, tf, indent="\t")
+			with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(self.filename), delete=False) as tf:
+				tf.write(raw)
 				tempname = tf.name
 
-			os.replace(tempname, self.filename)	
+			os.replace(tempname, self.filename)
 			os.chmod(self.filename, 0o664)
 
+		self._stat = self._signature()
+
+	def _replay(self, journal, data, lock=True):
+		if not os.path.isfile(journal):
+			return
+
+		try:
+			with LockedOpen(journal, 'r', shared=True) if lock else open(journal, 'r') as fh:
+				for line in fh:
+					try:
+						record = json.loads(line)
+					except ValueError:
+						break # torn record at the end of a crashed write
+
+					if 'v' in record:
+						data[record['k']] = record['v']
+					else:
+						data.pop(record['k'], None)
+
+		except FileNotFoundError:
+			pass # compacted away (e.g., by another process) while we waited
+
+	def _append(self, keys):
+		''' Append a record per changed key (a delete record for a key no
+			longer present) to the journal.
+		'''
+		records = []
+		for k in keys:
+			if dict.__contains__(self, k):
+				records.append(json.dumps({ 'k': k, 'v': dict.__getitem__(self, k) }, separators=(',', ':')))
+			else:
+				records.append(json.dumps({ 'k': k }, separators=(',', ':')))
+
+		with LockedOpen(self.journal, 'a') as fh:
+			fh.write('\n'.join(records) + '\n')
+			fh.flush()
+			size = fh.tell()
+
+		self._stat = self._signature()
+
+		if size > self.journal_limit and self._compactor is None:
+			self._compactor = threading.Thread(target=self.compact, daemon=True)
+			self._compactor.start()
+
+	def compact(self):
+		''' Fold the journal into the file.  The journal is set aside (and
+			a new one started) while the file is rewritten, so a crash at
+			any point leaves a file and journal(s) that replay correctly.
+			The new file is built from the file and the set aside journal,
+			so records appended by other processes are kept.
+		'''
+		if not self.journal:
+			return
+
+		with self._compact_lock:
+			old = self.journal + '.old'
+
+			try:
+				# the lock on the set aside journal keeps out compactions in
+				# other processes until this one has removed it
+				with LockedOpen(old, 'a'):
+					# under the journal's lock, so no appender (here or in
+					# another process) writes to a journal being set aside
+					if os.path.exists(self.journal):
+						with LockedOpen(self.journal, 'a'):
+							with open(self.journal, 'r') as src, open(old, 'a') as dst:
+								dst.write(src.read())
+							os.remove(self.journal)
+
+					data = {}
+					if os.path.isfile(self.filename) and os.path.getsize(self.filename) > 0:
+						with open(self.filename, 'rb') as fh:
+							raw = fh.read()
+						data = _detect(raw).loads(raw)
+
+					self._replay(old, data, lock=False)
+
+					self._write(self.serializer.dumps(data))
+					os.remove(old)
+
+				# the file may now hold changes from other processes
+				self._stat = None
+
+			except Exception:
+				logging.getLogger(__name__).exception('Compacting {0} failed'.format(self.journal))
+
+			finally:
+				self._compactor = None
+
 	def _update(self, *args, **kwargs):
 		# internal update does not trigger dump
 		for k, v in dict(*args, **kwargs).items():
 			if isinstance(v, dict):
-				v.update(self.get(k, {}))
-			dict.__setitem__(self, k, v)
+				dict.update(v, dict.get(self, k, {}))
+			dict.__setitem__(self, k, self._track(k, v))
+
+	def _track(self, key, value):
+		return _track(value, self, (key,)) if self.track else value
+
+	def _touched(self, path):
+		''' Called by tracked values when changed at the given key path.
+		'''
+		with self._lock:
+			self._paths.add(path)
+			self._changed([ path[0] ])
+
+	def changes(self):
+		''' Returns the set of key paths (tuples) changed since the last write.
+		'''
+		with self._lock:
+			return set(self._paths)
+
+	def _changed(self, keys):
+		''' Record changed keys and write them now, at the end of the
+			current transaction or after the flush_interval.
+		'''
+		with self._lock:
+			self._dirty.update(keys)
+
+			if self._depth:
+				return
+
+			if self.flush_interval and not self._closed:
+				self._defer()
+				return
+
+			self.flush()
+
+	def _defer(self):
+		now = time.monotonic()
+
+		if self._first_change is None:
+			self._first_change = now
+
+		self._deadline = min(now + self.flush_interval,
+			self._first_change + self.flush_interval * self.MAX_DEFER_INTERVALS)
+
+		if self._flusher is None:
+			self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+			self._flusher.start()
+			atexit.register(self.close)
+
+		self._wakeup.notify()
+
+	def _flush_loop(self):
+		with self._lock:
+			while not self._closed:
+				if self._deadline is None:
+					self._wakeup.wait()
+					continue
+
+				remaining = self._deadline - time.monotonic()
+				if remaining > 0:
+					self._wakeup.wait(remaining)
+					continue
+
+				try:
+					self.flush()
+				except Exception:
+					# e.g., ENOSPC - the changes stay pending, try again later
+					logging.getLogger(__name__).exception("Failed to write {0}".format(self.filename))
+					self._deadline = time.monotonic() + self.flush_interval
+
+	def flush(self):
+		''' Write pending changes (if any) to the file.
+		'''
+		with self._lock:
+			self._deadline = self._first_change = None
+
+			if not self._dirty:
+				return
+
+			changed = self._diff(self._dirty)
+
+			# the keys stay dirty unless the store succeeds
+			if changed:
+				self._store(list(changed))
+				self._written(changed)
+
+			self._dirty.clear()
+			self._paths.clear()
+
+	def _store(self, keys):
+		''' Persist the changed keys.
+		'''
+		if self.journal:
+			self._append(keys)
+		else:
+			self._dump()
+
+	def close(self):
+		''' Stop the background writer and write any pending changes.
+		'''
+		with self._lock:
+			self._closed = True
+			self._wakeup.notify()
+
+		if self._flusher is not None and self._flusher is not threading.current_thread():
+			self._flusher.join()
+
+		self.flush()
+
+		compactor = self._compactor
+		if compactor is not None:
+			compactor.join()
+
+	@contextmanager
+	def transaction(self):
+		''' Merge all changes made within the context into one write.
+			Transactions can be nested; the write happens when the
+			outermost one ends.
+		'''
+		with self._lock:
+			self._depth += 1
+
+		try:
+			yield self
+
+		finally:
+			with self._lock:
+				self._depth -= 1
+
+				if not self._depth:
+					self.flush()
 
 	def __getitem__(self, key):
+		self._refresh()
 		return dict.__getitem__(self, key)
 
+	def get(self, key, default=None):
+		self._refresh()
+		return dict.get(self, key, default)
+
+	def __contains__(self, key):
+		self._refresh()
+		return dict.__contains__(self, key)
+
+	def __iter__(self):
+		self._refresh()
+		return dict.__iter__(self)
+
+	def __len__(self):
+		self._refresh()
+		return dict.__len__(self)
+
+	def keys(self):
+		self._refresh()
+		return dict.keys(self)
+
+	def items(self):
+		self._refresh()
+		return dict.items(self)
+
+	def values(self):
+		self._refresh()
+		return dict.values(self)
+
 	def __setitem__(self, key, val):
-		dict.__setitem__(self, key, val)
-		self._dump()
+		with self._lock:
+			dict.__setitem__(self, key, self._track(key, val))
+			self._paths.add((key,))
+			self._changed([ key ])
+
+	def __delitem__(self, key):
+		with self._lock:
+			dict.__delitem__(self, key)
+			self._paths.add((key,))
+			self._changed([ key ])
 
 	def __repr__(self):
+		self._refresh()
 		dictrepr = dict.__repr__(self)
 		return '%s(%s)' % (type(self).__name__, dictrepr)
 
 	def update(self, *args, **kwargs):
-		self._update(*args, **kwargs)
-		self._dump()
-
+		with self._lock:
+			items = dict(*args, **kwargs)
+			self._update(items)
+			self._paths.update((k,) for k in items)
+			self._changed(items.keys())
@@ -0,0 +1,138 @@
+import sqlite3, json
+
+from .DictPersistJSON import DictPersistJSON, _canonical
+
+class DictPersistSQLite(DictPersistJSON):
+	''' A DictPersistJSON kept in a SQLite table (one row per key, the value
+		as JSON) instead of a JSON file, for stores that grow without bound.
+		Writing a change updates only the rows of the changed keys, and the
+		database runs in WAL mode so readers in other processes don't block
+		the writer (or each other).
+
+		The dict itself is the read cache.  Transactions, flush_interval,
+		coherent reads and nested change tracking work as they do for
+		DictPersistJSON, and each flush is committed as one SQLite
+		transaction.  coherent reads use SQLite's data_version to notice
+		commits by other processes, and a version column (the number of the
+		commit that last wrote each row) to reload only the rows they changed.
+
+			alarms = DictPersistSQLite(Config.PATHS.STORE_DB, table='alarms')
+	'''
+	def __init__(self, filename, *args, table='store', **kwargs):
+		self.table = '"{0}"'.format(table.replace('"', '""'))
+		self._rows = {} # canonical JSON value of each row as last read or written
+		self._version = 0 # highest row version read
+
+		self._conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+		self._conn.execute('PRAGMA journal_mode=WAL')
+		self._conn.execute('PRAGMA synchronous=NORMAL')
+		self._conn.execute('CREATE TABLE IF NOT EXISTS {0} (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+			'version INTEGER NOT NULL DEFAULT 0)'.format(self.table))
+
+		# tables created before the version column
+		columns = [ row[1] for row in self._conn.execute('PRAGMA table_info({0})'.format(self.table)) ]
+		if 'version' not in columns:
+			self._conn.execute('ALTER TABLE {0} ADD COLUMN version INTEGER NOT NULL DEFAULT 0'.format(self.table))
+
+		self._conn.execute('CREATE INDEX IF NOT EXISTS "{0}_version" ON {1} (version)'.format(
+			table.replace('"', '""'), self.table))
+
+		kwargs.pop('journal', None)
+		kwargs.pop('serializer', None)
+
+		# only the initial values (merged with the stored ones) are written at start
+		self._initial = set(k for k in dict(*args, **{ k: v for k, v in kwargs.items()
+			if k not in ('flush_interval', 'journal_limit', 'coherent', 'track') }))
+
+		DictPersistJSON.__init__(self, filename, *args, **kwargs)
+
+		self._initial = None
+
+	def _read(self):
+		with self._lock:
+			rows = self._conn.execute('SELECT key, value, version FROM {0}'.format(self.table)).fetchall()
+
+		self._rows = { k: v for k, v, _ in rows }
+		self._version = max([ version for _, _, version in rows ] or [ 0 ])
+
+		return { k: json.loads(v) for k, v, _ in rows }
+
+	def _reload(self):
+		''' Apply the rows changed (and deleted) by other processes.
+		'''
+		with self._lock:
+			changed = self._conn.execute('SELECT key, value, version FROM {0} WHERE version > ?'.format(self.table),
+				(self._version,)).fetchall()
+			keys = set(row[0] for row in self._conn.execute('SELECT key FROM {0}'.format(self.table)))
+
+			for k in [ k for k in self._rows if k not in keys ]:
+				del self._rows[k]
+				self._unload(k)
+
+			for k, v, version in changed:
+				self._rows[k] = v
+				self._version = max(self._version, version)
+				self._reload_key(k, json.loads(v))
+
+	def _snapshot(self):
+		# rows are stored as canonical JSON, so they are the written sections
+		self._sections = self._rows
+
+	def _signature(self):
+		# data_version changes only when another connection commits
+		with self._lock:
+			return self._conn.execute('PRAGMA data_version').fetchone()
+
+	def _dump(self):
+		keys = self._initial if self._initial is not None else dict.keys(self)
+		self._store(list(keys) + [ k for k in self._rows if not dict.__contains__(self, k) ])
+
+	def _store(self, keys):
+		upserts, deletes = {}, []
+
+		for k in keys:
+			if dict.__contains__(self, k):
+				value = _canonical(dict.__getitem__(self, k))
+				if self._rows.get(k) != value:
+					upserts[k] = value
+
+			elif k in self._rows:
+				deletes.append((k,))
+
+		if not upserts and not deletes:
+			return
+
+		with self._lock:
+			self._conn.execute('BEGIN IMMEDIATE')
+			try:
+				latest = self._conn.execute('SELECT coalesce(max(version), 0) FROM {0}'.format(self.table)).fetchone()[0]
+
+				self._conn.executemany('INSERT OR REPLACE INTO {0} (key, value, version) VALUES (?, ?, ?)'.format(self.table),
+					[ (k, v, latest + 1) for k, v in upserts.items() ])
+				self._conn.executemany('DELETE FROM {0} WHERE key = ?'.format(self.table), deletes)
+
+				self._conn.execute('COMMIT')
+			except:
+				if self._conn.in_transaction:
+					self._conn.execute('ROLLBACK')
+				raise
+
+			# only now are the rows written
+			self._rows.update(upserts)
+			for (k,) in deletes:
+				self._rows.pop(k, None)
+
+			# skip our own rows on the next reload, unless others committed
+			# rows we haven't read yet
+			if latest == self._version:
+				self._version = latest + 1
+
+	def compact(self):
+		''' Checkpoint the WAL into the database file.
+		'''
+		with self._lock:
+			self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+	def close(self):
+		DictPersistJSON.close(self)
+		self._conn.close()
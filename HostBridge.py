@@ -0,0 +1,478 @@
+''' Host command bridge for Cme packages running inside docker containers.
+
+	Commands are sent to the docker host over the FIFO_IN named pipe and
+	replies come back over a per-client reply FIFO created next to FIFO_OUT.
+	Every message is a frame:
+
+		request id (uint32) | payload length (uint32) | JSON payload
+
+	Request payloads name the reply FIFO and the command to run, e.g.,
+	{ "reply": "/tmp/cmehostoutput.12.ab34cd56", "cmd": ["systemctl", "is-active", "ntp"] }
+	and reply payloads carry the exit status and the combined output:
+	{ "status": 0, "output": "active\n" }.
+
+	A batch request carries an ordered list of commands instead,
+	{ "reply": ..., "batch": [[...], [...]], "stop_on_error": true }, and
+	is answered with { "results": [{ "status": ..., "output": ... }, ...] }
+	holding one entry per command actually run.
+
+	The FIFO handles stay open for the life of the bridge and a reader thread
+	hands each reply to the caller waiting on its request id, so several
+	threads (or processes, each with its own reply FIFO) can have commands
+	in flight at once.
+
+	HostServer is the host side of the protocol.  It can be run on the host,
+	or locally as a stand-in for load-testing the bridge:
+
+		$ python -m common.HostBridge
+'''
+import os, stat, json, struct, threading, itertools, subprocess, fcntl, select, uuid, atexit, errno, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from . import FIFO_IN, FIFO_OUT
+
+# frame header: request id, payload length
+_HEADER = struct.Struct('!II')
+
+# how often a client retries opening FIFO_IN while the host isn't reading
+_OPEN_RETRY_s = 0.05
+
+
+def _remaining(deadline):
+	''' Seconds left until a monotonic deadline (None if there is none).
+		Raises (futures) TimeoutError once it has passed.
+	'''
+	if deadline is None:
+		return None
+
+	left = deadline - time.monotonic()
+	if left <= 0:
+		raise FutureTimeoutError('Host bridge request timed out')
+
+	return left
+
+
+def _write_frame(fd, request_id, payload, deadline=None):
+	data = json.dumps(payload).encode()
+	frame = memoryview(_HEADER.pack(request_id, len(data)) + data)
+
+	while frame:
+		if deadline is None:
+			n = os.write(fd, frame)
+		else:
+			# a writable pipe has room for PIPE_BUF bytes, so this
+			# write doesn't block
+			if not select.select([], [fd], [], _remaining(deadline))[1]:
+				_remaining(deadline)
+				continue
+			n = os.write(fd, frame[:select.PIPE_BUF])
+
+		frame = frame[n:]
+
+
+def _read_exact(fd, size):
+	chunks = []
+	while size:
+		chunk = os.read(fd, size)
+		if not chunk:
+			return None
+		chunks.append(chunk)
+		size -= len(chunk)
+
+	return b''.join(chunks)
+
+
+def _read_frame(fd):
+	''' Returns (request_id, payload) or None if the FIFO was closed.  An
+		empty frame (see HostBridge.close) gives a None payload.
+	'''
+	header = _read_exact(fd, _HEADER.size)
+	if header is None:
+		return None
+
+	request_id, size = _HEADER.unpack(header)
+	if size == 0:
+		return request_id, None
+
+	data = _read_exact(fd, size)
+	if data is None:
+		return None
+
+	return request_id, json.loads(data.decode())
+
+
+class HostBridge(object):
+	''' Client end of the host command bridge.  Use host_bridge() to get the
+		shared per-process instance rather than creating these directly.
+	'''
+	def __init__(self, fifo_in=FIFO_IN, fifo_out=FIFO_OUT):
+		self.fifo_in = fifo_in
+		self.reply_path = '{0}.{1}.{2}'.format(fifo_out, os.getpid(), uuid.uuid4().hex[:8])
+		self.pid = os.getpid()
+
+		self._ids = itertools.count(1)
+		self._pending = {}
+		self._lock = threading.Lock()
+		self._write_lock = threading.Lock()
+		self._in_fd = None
+		self._out_fd = None
+		self._reader = None
+
+	def _open(self, deadline=None):
+		with self._lock:
+			if self._in_fd is not None:
+				return
+
+		# Opened outside the lock: until the host reads FIFO_IN the open
+		# fails with ENXIO and is retried (to the deadline), where a
+		# blocking open would hang the caller and close().
+		while True:
+			try:
+				in_fd = os.open(self.fifo_in, os.O_WRONLY | os.O_NONBLOCK)
+				break
+			except OSError as e:
+				if e.errno != errno.ENXIO:
+					raise
+
+			left = _remaining(deadline)
+			time.sleep(_OPEN_RETRY_s if left is None else min(_OPEN_RETRY_s, left))
+
+		os.set_blocking(in_fd, True)
+
+		with self._lock:
+			if self._in_fd is not None:
+				os.close(in_fd) # another thread got there first
+				return
+
+			if not os.path.exists(self.reply_path):
+				os.mkfifo(self.reply_path, 0o666)
+
+			# O_RDWR keeps the reply FIFO from ever reading EOF between replies
+			self._out_fd = os.open(self.reply_path, os.O_RDWR)
+			self._in_fd = in_fd
+
+			self._reader = threading.Thread(target=self._read_replies, args=(self._out_fd,), daemon=True)
+			self._reader.start()
+
+	def _lock_in_fd(self, deadline):
+		# the writer lock of FIFO_IN, shared with other client processes
+		while True:
+			try:
+				fcntl.flock(self._in_fd, fcntl.LOCK_EX | (0 if deadline is None else fcntl.LOCK_NB))
+				return
+			except BlockingIOError:
+				left = _remaining(deadline)
+				time.sleep(min(_OPEN_RETRY_s, left))
+
+	def submit(self, payload, timeout=None):
+		''' Send a request payload to the host and return a Future that
+			resolves to the reply payload.  Raises TimeoutError if the
+			request can't be sent within timeout seconds.
+		'''
+		deadline = None if timeout is None else time.monotonic() + timeout
+
+		self._open(deadline)
+
+		request_id = next(self._ids) & 0xffffffff
+		future = Future()
+
+		with self._lock:
+			self._pending[request_id] = future
+
+		# drop the pending entry if the caller gives up (e.g., cancelled)
+		future.add_done_callback(lambda f: self._forget(request_id))
+
+		payload = dict(payload, reply=self.reply_path)
+
+		written = False
+
+		try:
+			# frames larger than PIPE_BUF are not written atomically, so
+			# serialize writers in this process and across processes
+			while not self._write_lock.acquire(timeout=-1 if deadline is None else _remaining(deadline)):
+				pass
+
+			try:
+				self._lock_in_fd(deadline)
+				try:
+					written = True
+					_write_frame(self._in_fd, request_id, payload, deadline)
+				finally:
+					fcntl.flock(self._in_fd, fcntl.LOCK_UN)
+			finally:
+				self._write_lock.release()
+
+		except (OSError, FutureTimeoutError) as e:
+			with self._lock:
+				self._pending.pop(request_id, None)
+
+			# a partly written frame leaves FIFO_IN out of step
+			if written or not isinstance(e, FutureTimeoutError):
+				self.close()
+			raise
+
+		return future
+
+	def request(self, payload, timeout=None):
+		''' Send a request payload and wait for its reply payload.
+		'''
+		deadline = None if timeout is None else time.monotonic() + timeout
+		future = self.submit(payload, timeout)
+
+		try:
+			return future.result(None if deadline is None else max(deadline - time.monotonic(), 0))
+		except FutureTimeoutError:
+			future.cancel()
+			raise
+
+	def _forget(self, request_id):
+		with self._lock:
+			self._pending.pop(request_id, None)
+
+	def run(self, command, timeout=None):
+		''' Run a command on the host.  Returns (exit status, output).
+		'''
+		reply = self.request({ 'cmd': list(command) }, timeout)
+		return reply['status'], reply['output']
+
+	def run_batch(self, commands, stop_on_error=True, timeout=None):
+		''' Run an ordered list of commands on the host in one round trip.
+			Returns a list of (exit status, output), one per command run.
+			If stop_on_error, the host stops at the first non-zero status
+			and the remaining commands are not run (or returned).
+		'''
+		reply = self.request({
+			'batch': [ list(c) for c in commands ],
+			'stop_on_error': stop_on_error
+		}, timeout)
+
+		return [ (r['status'], r['output']) for r in reply['results'] ]
+
+	def _read_replies(self, fd):
+		# the reader owns the reply fd: close() wakes it with an empty frame
+		try:
+			while True:
+				frame = _read_frame(fd)
+				if frame is None or frame[1] is None:
+					break
+
+				request_id, reply = frame
+
+				with self._lock:
+					future = self._pending.pop(request_id, None)
+
+				if future is not None and future.set_running_or_notify_cancel():
+					future.set_result(reply)
+		except OSError:
+			pass
+
+		try:
+			os.close(fd)
+		except OSError:
+			pass
+
+		self._fail_pending()
+
+	def _fail_pending(self):
+		with self._lock:
+			pending = list(self._pending.values())
+			self._pending.clear()
+
+		for future in pending:
+			if future.set_running_or_notify_cancel():
+				future.set_exception(ConnectionError('Host bridge closed'))
+
+	def close(self):
+		''' Close the FIFOs.  Requests still in flight fail with ConnectionError.
+		'''
+		with self._lock:
+			in_fd, out_fd, reader = self._in_fd, self._out_fd, self._reader
+			self._in_fd = self._out_fd = self._reader = None
+
+		if in_fd is not None:
+			try:
+				os.close(in_fd)
+			except OSError:
+				pass
+
+		# an empty frame stops the reader, which then closes out_fd
+		if out_fd is not None:
+			try:
+				os.write(out_fd, _HEADER.pack(0, 0))
+			except OSError:
+				pass
+
+			if reader is not None and reader is not threading.current_thread():
+				reader.join(1.0)
+
+		self._fail_pending()
+
+		try:
+			os.remove(self.reply_path)
+		except OSError:
+			pass
+
+
+_bridge = None
+_bridge_lock = threading.Lock()
+
+def host_bridge():
+	''' Return the shared bridge for this process (a fresh one after a fork).
+	'''
+	global _bridge
+
+	with _bridge_lock:
+		if _bridge is None or _bridge.pid != os.getpid():
+			_bridge = HostBridge()
+			atexit.register(_bridge.close)
+
+		return _bridge
+
+
+
+class HostServer(object):
+	''' Host side of the bridge.  Reads request frames from fifo_in, runs
+		them on a pool of worker threads and writes each reply to the reply
+		FIFO named in its request.
+
+		runner(command) -> (status, output) can be replaced to load-test the
+		bridge without running real commands.
+	'''
+	def __init__(self, fifo_in=FIFO_IN, workers=4, runner=None, fifo_out=FIFO_OUT):
+		self.fifo_in = fifo_in
+		self.fifo_out = fifo_out
+		self.runner = runner or run_command
+
+		self._pool = ThreadPoolExecutor(max_workers=workers)
+		self._replies = {}
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+		self._thread = None
+
+	def start(self):
+		''' Serve from a background thread.
+		'''
+		self._prepare()
+		self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self._thread.start()
+		return self
+
+	def stop(self):
+		self._stop.set()
+		if self._thread:
+			self._thread.join()
+		self._pool.shutdown()
+
+		with self._lock:
+			for fd, _ in self._replies.values():
+				os.close(fd)
+			self._replies.clear()
+
+	def _prepare(self):
+		if not os.path.exists(self.fifo_in):
+			os.mkfifo(self.fifo_in, 0o666)
+
+	def serve_forever(self):
+		self._prepare()
+
+		fd = os.open(self.fifo_in, os.O_RDWR)
+		try:
+			while not self._stop.is_set():
+				ready, _, _ = select.select([fd], [], [], 0.5)
+				if not ready:
+					continue
+
+				frame = _read_frame(fd)
+				if frame is None:
+					break
+
+				self._pool.submit(self._handle, *frame)
+		finally:
+			os.close(fd)
+
+	def execute(self, payload):
+		''' Build the reply payload for a request payload.
+		'''
+		if 'batch' in payload:
+			results = []
+			for command in payload['batch']:
+				status, output = self.runner(command)
+				results.append({ 'status': status, 'output': output })
+
+				if status != 0 and payload.get('stop_on_error', True):
+					break
+
+			return { 'results': results }
+
+		status, output = self.runner(payload['cmd'])
+		return { 'status': status, 'output': output }
+
+	def _handle(self, request_id, payload):
+		try:
+			reply = self.execute(payload)
+		except Exception as e:
+			reply = { 'status': -1, 'output': str(e) }
+
+			# a batch reply is a list of results (HostBridge.run_batch)
+			if 'batch' in payload:
+				reply = { 'results': [ reply ] }
+
+		path = payload.get('reply')
+		if not path:
+			return
+
+		fd, lock = self._reply_fd(path)
+		if fd is None:
+			return
+
+		try:
+			with lock:
+				_write_frame(fd, request_id, reply)
+		except OSError:
+			# client went away
+			with self._lock:
+				self._replies.pop(path, None)
+			os.close(fd)
+
+	def _reply_fd(self, path):
+		''' Returns (fd, lock) of a client's reply FIFO, or (None, None) if it
+			is gone or isn't a reply FIFO (only FIFOs named fifo_out.* are
+			written, never a regular file or a symlink).
+		'''
+		if not path.startswith(self.fifo_out + '.') or '/' in path[len(self.fifo_out):]:
+			return None, None
+
+		with self._lock:
+			if path not in self._replies:
+				try:
+					# non-blocking open fails fast (ENXIO) if the client is gone
+					fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK | os.O_NOFOLLOW)
+				except OSError as e:
+					if e.errno in (errno.ENXIO, errno.ENOENT, errno.ELOOP):
+						return None, None
+					raise
+
+				if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+					os.close(fd)
+					return None, None
+
+				os.set_blocking(fd, True)
+				self._replies[path] = (fd, threading.Lock())
+
+			return self._replies[path]
+
+
+def run_command(command):
+	''' Default HostServer runner.  Returns (exit status, combined output).
+	'''
+	try:
+		result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	except OSError as e:
+		return 127, str(e)
+
+	return result.returncode, result.stdout.decode(errors='replace')
+
+
+if __name__ == '__main__':
+	HostServer().serve_forever()
@@ -1,27 +1,129 @@
-import os, platform, logging, subprocess
-import uuid, socket, fcntl, struct, fileinput
+import os, platform, logging, threading, time
+import uuid, socket, fcntl, struct
+from collections import namedtuple
 
-from . import is_a_cme, is_a_docker, docker_run
+from . import is_a_cme, ServiceUtils
 
-# RPi uses only single network interface, 'eth0'
+# default network interface (the RPi has only 'eth0'), the functions
+# below take an iface parameter for the others (e.g., 'wlan0', 'usb0')
 iface = b'eth0'
 
+# network_snapshot() results are reused for this many seconds
+SNAPSHOT_TTL = 2.0
 
-def mac():
-	''' Return the network interface MAC address.
+NetworkSnapshot = namedtuple('NetworkSnapshot', 'iface mac dhcp address netmask gateway time')
 
-		Note: requires Linux OS.
+_snapshots = {}
+_snapshot_lock = threading.Lock()
+
+# ioctls and route flag used below
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891B
+RTF_GATEWAY = 0x2
+
+
+def _name(name=None):
+	''' Interface name as a str, defaulting to iface.
 	'''
-	# old way (didn't work well under docker container)
-	#return str(':'.join(['{:02x}'.format((uuid.getnode() >> i) & 0xff) for i in range(0,8*6,8)][::-1])).upper()
+	name = iface if name is None else name
+	return name.decode() if isinstance(name, bytes) else name
+
+
+def interfaces():
+	''' Return the names of the network interfaces.
+
+		If not a cme module, this function always returns [ 'eth0' ].
+	'''
+	if not is_a_cme():
+		return [ _name() ]
+
+	return sorted(os.listdir('/sys/class/net'))
+
+
+def network_snapshot(ttl=None, iface=None):
+	''' Return an interface's MAC, DHCP state, address, netmask and default
+		gateway in one pass (sysfs, two ioctls on one socket and /proc/net/route,
+		no subprocess).  The result is cached for ttl seconds (SNAPSHOT_TTL by
+		default); invalidate_snapshot() drops it after a reconfiguration.  A
+		running NetWatcher invalidates it on every change, so a long ttl is safe.
+
+		Addresses are None if the interface doesn't have them (yet).
+
+		If not a cme module, the fixed values of the getters below are returned.
+	'''
+	name = _name(iface)
 
 	if not is_a_cme():
-		return "00:12:34:AB:CD:EF"
+		return NetworkSnapshot(name, "00:12:34:AB:CD:EF", True,
+			'127.0.0.30', '255.255.255.0', '127.0.0.1', time.monotonic())
 
-	with open('/sys/class/net/' + iface.decode() + '/address') as f:
+	ttl = SNAPSHOT_TTL if ttl is None else ttl
+
+	with _snapshot_lock:
+		snapshot = _snapshots.get(name)
+		if snapshot is None or time.monotonic() - snapshot.time > ttl:
+			snapshot = _snapshots[name] = _read_snapshot(name)
+
+		return snapshot
+
+
+def invalidate_snapshot(iface=None):
+	''' Drop the cached network_snapshot() of an interface, or of all of
+		them (e.g., after changing the network).
+	'''
+	with _snapshot_lock:
+		if iface is None:
+			_snapshots.clear()
+		else:
+			_snapshots.pop(_name(iface), None)
+
+
+def _read_snapshot(name):
+	with open('/sys/class/net/' + name + '/address') as f:
 		mac = f.read().strip().upper()
 
-	return mac
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+		address = _ioctl_addr(sock, SIOCGIFADDR, name)
+		netmask = _ioctl_addr(sock, SIOCGIFNETMASK, name)
+
+	return NetworkSnapshot(name, mac, dhcp(), address, netmask, _route_gateway(name), time.monotonic())
+
+
+def _ioctl_addr(sock, request, name):
+	ifreq = struct.pack('16sH14s', name.encode(), socket.AF_INET, b'\x00'*14)
+
+	try:
+		res = fcntl.ioctl(sock.fileno(), request, ifreq)
+	except OSError:
+		return None # e.g., no address assigned
+
+	return socket.inet_ntoa(struct.unpack('16sH2x4s8x', res)[2])
+
+
+def _route_gateway(name):
+	''' Read the interface's default gateway directly from /proc.
+	'''
+	with open('/proc/net/route') as f:
+		next(f) # header
+		for line in f:
+			fields = line.split()
+			if fields[0] != name or fields[1] != '00000000' or not int(fields[3], 16) & RTF_GATEWAY:
+				continue
+
+			return socket.inet_ntoa(struct.pack('<L', int(fields[2], 16)))
+
+	return None
+
+
+def mac(iface=None):
+	''' Return a network interface MAC address.
+
+		Note: requires Linux OS.
+	'''
+	# old way (didn't work well under docker container)
+	#return str(':'.join(['{:02x}'.format((uuid.getnode() >> i) & 0xff) for i in range(0,8*6,8)][::-1])).upper()
+
+	return network_snapshot(iface=iface).mac
 
 
 def dhcp():
@@ -43,55 +145,28 @@ def dhcp():
 	return ifaces.find('dhcp') > -1
 
 
-def address():
-	''' Return the current eth0 interface ip address.
+def address(iface=None):
+	''' Return the current ip address of an interface (eth0 by default).
 
 		If not a cme module, this function always returns '127.0.0.30'.
 	'''
-	if not is_a_cme():
-		return '127.0.0.30'
-
-	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-	ifreq = struct.pack('16sH14s', iface, socket.AF_INET, b'\x00'*14)
-
-	res = fcntl.ioctl(sock.fileno(), 0x8915, ifreq)
-	ip = struct.unpack('16sH2x4s8x', res)[2]
+	return network_snapshot(iface=iface).address
 
-	return socket.inet_ntoa(ip)
 
-
-def netmask():
-	''' Return the current netmask.
+def netmask(iface=None):
+	''' Return the current netmask of an interface.
 
 		if not a cme device, this function always returns '255.255.255.0'.
 	'''
-	if not is_a_cme():
-		return '255.255.255.0'
-
-	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-	s = struct.pack('256s', iface)
-	res = fcntl.ioctl(sock, 0x891B, s)[20:24]
+	return network_snapshot(iface=iface).netmask
 
-	return socket.inet_ntoa(res)
 
-
-def gateway():
-	''' Read the default gateway directly from /proc.
+def gateway(iface=None):
+	''' Return the default gateway through an interface (read directly from /proc).
 
 		If not a cme module, this function always returns '127.0.0.1'.
 	'''
-	if not is_a_cme():
-		return '127.0.0.1'
-
-	#with open('/proc/net/route') as f:
-	#	for line in f:
-	#		fields = line.strip().split()
-	#		if fields[1] != '00000000' or not int(fields[3], 16) & 2:
-	#			continue
-	#return socket.inet_ntoa(struct.pack('<L', int(fields[2], 16)))
-	gw = subprocess.run(['ip','route', 'show', '0.0.0.0/0', 'dev', 'eth0'], stdout=subprocess.PIPE).stdout
-	gw = gw.strip().decode().split(' ')[2]
-	return gw
+	return network_snapshot(iface=iface).gateway
 
 
 def set_dhcp(on=True):
@@ -99,15 +174,32 @@ def set_dhcp(on=True):
 		only sets the configuration.  A network restart or a full reboot
 		is necessary for the change to occur.
 
+		Returns True if the configuration changed.
+
 		If not a cme device, this function does nothing.
 	'''
 	if not is_a_cme():
-		return
+		return False
+
+	link = '/etc/network/interfaces'
+	target = '/etc/network/interfaces_dhcp' if on else '/etc/network/interfaces_static'
 
-	if on:
-		os.system('ln -s -f /etc/network/interfaces_dhcp /etc/network/interfaces')
-	else:
-		os.system('ln -s -f /etc/network/interfaces_static /etc/network/interfaces')
+	try:
+		if os.readlink(link) == target:
+			return False
+	except OSError:
+		pass # missing, or not a link
+
+	# swap the link atomically
+	tmp = '{0}.{1}.tmp'.format(link, os.getpid())
+	if os.path.lexists(tmp):
+		os.remove(tmp)
+
+	os.symlink(target, tmp)
+	os.replace(tmp, link)
+
+	invalidate_snapshot()
+	return True
 
 
 # looks at network settings compared with current network
@@ -117,7 +209,8 @@ def manage_network(user_settings):
 	network_settings = user_settings['network']
 
 	reload_network = False
-	currently_dhcp = dhcp()
+	current = network_snapshot(ttl=0)
+	currently_dhcp = current.dhcp
 
 	use_dhcp = network_settings['dhcp']
 
@@ -127,101 +220,151 @@ def manage_network(user_settings):
 	logger.info("Network\t\tSetting\t(current)")
 	logger.info("\tMAC:\t\t{0}".format(network_settings['mac']))
 	logger.info("\tDHCP:\t\t{0}\t\t({1})".format(network_settings['dhcp'], currently_dhcp))
-	logger.info("\tIP:\t\t{0}\t({1})".format(network_settings['address'], address()))
-	logger.info("\tMASK:\t\t{0}\t({1})".format(network_settings['netmask'], netmask()))
-	logger.info("\tGATE:\t\t{0}\t({1})".format(network_settings['gateway'], gateway()))
+	logger.info("\tIP:\t\t{0}\t({1})".format(network_settings['address'], current.address))
+	logger.info("\tMASK:\t\t{0}\t({1})".format(network_settings['netmask'], current.netmask))
+	logger.info("\tGATE:\t\t{0}\t({1})".format(network_settings['gateway'], current.gateway))
 
 	if not is_a_cme():
 		logger.info("\tWARNING: Not a recognized CME platform - no actual changes will be made!")
 
 	# if settings say use DHCP and we're not
 	if use_dhcp != currently_dhcp:
-		reload_network = True
+		logger.info("Setting network to {0} configuration.".format('DHCP' if use_dhcp else 'static'))
+		reload_network = set_dhcp(use_dhcp)
 
-		# reset for dhcp
-		if use_dhcp:
-			logger.info("Setting network to DHCP configuration.")
-			set_dhcp(True)
+	# bring the static addresses (and nameservers) up to date - the
+	# network is only restarted if the file changed or isn't applied
+	if not use_dhcp:
+		if write_network_addresses(network_settings):
+			reload_network = True
+			logger.info("Updated network static addresses.")
 
-		# reset for static
-		else:
-			logger.info("Setting network to static configuration.")
-			set_dhcp(False)
-
-	# else dhcp settings match current state -
-	# check and update addresses if we're static
-	elif not use_dhcp and \
-		(address() != network_settings['address'] or \
-		 netmask() != network_settings['netmask'] or \
-		 gateway() != network_settings['gateway']):
+		elif use_dhcp == currently_dhcp and \
+			(current.address != network_settings['address'] or \
+			 current.netmask != network_settings['netmask'] or \
+			 current.gateway != network_settings['gateway']):
 
-		reload_network = True
-		logger.info("Updating network static addresses.")
+			reload_network = True
+			logger.info("Applying network static addresses.")
 
 	# Trigger network restart
 	if reload_network:
-		# update net addresses if not dhcp
-		if not use_dhcp:
-			write_network_addresses(network_settings)
-
 		# restart the network
-		cmd = ['systemctl', 'restart', 'networking']
+		if is_a_cme():
+			for status, output in ServiceUtils.manage_units(restart=[ 'networking' ]):
+				if status != 0:
+					logger.error("Network restart failed ({0}): {1}".format(status, output))
 
-		if is_a_cme() and is_a_docker():
-			docker_run(cmd)
-		elif is_a_cme():
-			subprocess.run(cmd)
+		invalidate_snapshot()
 
 	# load settings from DHCP values after network restarted
 	if use_dhcp:
+		current = network_snapshot()
 		network_settings.update({
-			'address': address(),
-			'netmask': netmask(),
-			'gateway': gateway()
+			'address': current.address,
+			'netmask': current.netmask,
+			'gateway': current.gateway
 			})
 		user_settings.update({ 'network': network_settings })
 
 
-def write_network_addresses(net_settings):
-	''' Updates the static network addresses (/etc/network/interfaces_static) with
-		the settings passed in.
+# keywords that start a stanza in interfaces(5) (besides allow-*)
+_STANZAS = ('iface', 'auto', 'mapping', 'source', 'source-directory')
 
-		If not a cme device, this function does nothing.
+
+def render_network_addresses(text, net_settings, iface=None):
+	''' Returns the interfaces file text with the static addresses and
+		nameservers of an interface's stanza (eth0 by default) replaced.
+		The other stanzas are left as they are.
 	'''
-	if not is_a_cme():
-		return
+	marker = "iface {0} inet static".format(_name(iface))
 
-	network_conf = '/etc/network/interfaces_static'
-	marker = "iface eth0 inet static"
+	# pluck addresses from settings
+	body = [ "\t{0} {1}".format(n, net_settings[n]) for n in ('address', 'netmask', 'gateway') ]
+
+	# add DNS nameservers
+	body.append("\tdns-nameservers {0} {1}".format(net_settings['primary'], net_settings['secondary']))
+	body.append("")
+
+	lines = []
+	comments = [] # unindented comments in our stanza, kept for the next one
 	found = False
-	added = False
+	done = False
 
-	# pluck addresses from settings
-	addresses = {
-		'address': net_settings['address'],
-		'netmask': net_settings['netmask'],
-		'gateway': net_settings['gateway']
-	}
-
-	# fileinput uses the print functions to write to the config file
-	for line in fileinput.input(network_conf, inplace=True):
+	for line in text.splitlines():
 		line = line.rstrip()
+
+		# replace the body of our stanza (up to the next stanza, option
+		# lines need not be indented)
+		if found and not done:
+			keyword = line.split(None, 1)[0] if line.strip() else ''
+			if keyword in _STANZAS or keyword.startswith('allow-'):
+				done = True
+				lines.extend(body)
+				lines.extend(comments)
+			else:
+				if line.startswith('#'):
+					comments.append(line)
+				continue
+
+		# dup lines outside of our stanza
+		lines.append(line)
 		found = found or line.startswith(marker)
 
-		# dup lines until marker
-		if not found or line.startswith(marker):
-			print(line)
-			continue
+	if found and not done:
+		lines.extend(body)
+		lines.extend(comments)
+
+	return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path, data):
+	''' Replace path with data (bytes) so readers see the old or the new
+		file, never a partial one, and the new one survives a power cut.
+	'''
+	dirname = os.path.dirname(path) or '.'
+	tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+
+	with open(tmp, 'wb') as f:
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+
+	try:
+		os.chmod(tmp, os.stat(path).st_mode & 0o7777)
+	except OSError:
+		pass # new file
+
+	os.replace(tmp, path)
+
+	fd = os.open(dirname, os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+
+def write_network_addresses(net_settings, iface=None):
+	''' Updates the static network addresses (/etc/network/interfaces_static) of
+		an interface (eth0 by default) with the settings passed in.  The file
+		is only rewritten (atomically) if its content changes.
+
+		Returns True if the file changed.
+
+		If not a cme device, this function does nothing.
+	'''
+	if not is_a_cme():
+		return False
+
+	network_conf = '/etc/network/interfaces_static'
 
-		if not added:
-			added = True
+	with open(network_conf, 'rb') as f:
+		current = f.read()
 
-			# insert our updated addresses
-			for n, a in addresses.items():
-				print("\t{0} {1}".format(n, a))
+	rendered = render_network_addresses(current.decode(), net_settings, iface).encode()
 
-			# add DNS nameservers
-			print("\tdns-nameservers {0} {1}".format(net_settings['primary'], net_settings['secondary']))
-			print()
+	if rendered == current:
+		return False
 
-	fileinput.close()
+	_write_atomic(network_conf, rendered)
+	return True
@@ -1,28 +1,199 @@
-import os, fcntl
+import os, fcntl, time, threading
+
+
+class LockTimeout(TimeoutError):
+	''' Raised when a LockedOpen lock can't be acquired within its timeout.
+	'''
+	pass
+
+
+# contention metrics by (absolute) filename, see LockedOpen.stats()
+_stats = {}
+_stats_lock = threading.Lock()
+
+def _record(filename, **values):
+	with _stats_lock:
+		s = _stats.setdefault(os.path.abspath(filename), {
+			'acquired': 0, 'contended': 0, 'timeouts': 0, 'retries': 0,
+			'wait_s': 0.0, 'wait_max_s': 0.0, 'hold_s': 0.0, 'hold_max_s': 0.0
+		})
+
+		for k, v in values.items():
+			if k.endswith('_max_s'):
+				s[k] = max(s[k], v)
+			else:
+				s[k] += v
+
 
 class LockedOpen(object):
 	''' see https://blog.gocept.com/2013/07/15/reliable-file-updates-with-python/
 	    for details regarding this class and isolating file updates.
-	s'''
-	def __init__(self, filename, *args, **kwargs):
+
+		By default the file is opened under an exclusive lock, waiting as
+		long as it takes.  shared=True takes a shared (reader) lock instead,
+		and timeout (seconds) limits the wait, raising LockTimeout; timeout=0
+		is a non-blocking try.  try_acquire() returns None rather than
+		raising, and the lock can be taken without blocking an event loop
+		using "async with LockedOpen(...)" or acquire_async().
+
+		Wait and hold times, timeouts and the number of times the file was
+		replaced while we waited (retries) are kept per file, see stats().
+	'''
+	POLL_MIN_s = 0.001 # back-off between non-blocking attempts
+	POLL_MAX_s = 0.05
+
+	def __init__(self, filename, *args, shared=False, timeout=None, **kwargs):
 		self.filename = filename
 		self.open_args = args
 		self.open_kwargs = kwargs
+		self.shared = shared
+		self.timeout = timeout
 		self.fileobj = None
+		self._acquired = None
 
-	def __enter__(self):
-		f = open(self.filename, *self.open_args, **self.open_kwargs)
+	def _open(self):
+		return open(self.filename, *self.open_args, **self.open_kwargs)
+
+	def _flock(self, f, blocking):
+		''' Returns True if the lock was taken.
+		'''
+		op = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+
+		if blocking:
+			fcntl.flock(f, op)
+			return True
+
+		try:
+			fcntl.flock(f, op | fcntl.LOCK_NB)
+			return True
+		except BlockingIOError:
+			return False
+
+	def _locked(self, f, retries, start):
+		''' Finish an acquire once f is locked.  Returns (True, f), or
+			(False, new file) if the file was replaced while we waited.
+		'''
+		try:
+			fnew = self._open()
+		except BaseException:
+			f.close() # don't hold the lock until f is collected
+			raise
+
+		if os.path.sameopenfile(f.fileno(), fnew.fileno()):
+			fnew.close()
+
+			self._acquired = time.monotonic()
+			wait = self._acquired - start
+			_record(self.filename, acquired=1, contended=int(wait > self.POLL_MIN_s or retries > 0),
+				retries=retries, wait_s=wait, wait_max_s=wait)
+
+			self.fileobj = f
+			return True, f
+
+		f.close()
+		return False, fnew
+
+	def acquire(self, timeout=None):
+		''' Open and lock the file, returning the open file.
+		'''
+		timeout = self.timeout if timeout is None else timeout
+		start = time.monotonic()
+		deadline = None if timeout is None else start + timeout
+		delay = self.POLL_MIN_s
+		retries = 0
+
+		f = self._open()
 		while True:
-			fcntl.flock(f, fcntl.LOCK_EX)
-			fnew = open(self.filename, *self.open_args, **self.open_kwargs)
-			if os.path.sameopenfile(f.fileno(), fnew.fileno()):
-				fnew.close()
-				break
-			else:
-				f.close()
-				f = fnew
-		self.fileobj = f
-		return f
+			if not self._flock(f, blocking=deadline is None):
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					f.close()
+					_record(self.filename, timeouts=1, retries=retries)
+					raise LockTimeout('Timed out locking {0}'.format(self.filename))
+
+				time.sleep(min(delay, remaining))
+				delay = min(delay * 2, self.POLL_MAX_s)
+				continue
+
+			done, f = self._locked(f, retries, start)
+			if done:
+				return f
+
+			retries += 1
+
+	def try_acquire(self):
+		''' Non-blocking acquire.  Returns the open file, or None if the
+			lock is held elsewhere.
+		'''
+		try:
+			return self.acquire(timeout=0)
+		except LockTimeout:
+			return None
+
+	async def acquire_async(self, timeout=None):
+		''' acquire() that polls for the lock with asyncio.sleep() between
+			attempts instead of blocking the event loop.
+		'''
+		# imported here so synchronous users don't pay for it
+		import asyncio
+
+		timeout = self.timeout if timeout is None else timeout
+		start = time.monotonic()
+		delay = self.POLL_MIN_s
+		retries = 0
+
+		f = self._open()
+		while True:
+			if not self._flock(f, blocking=False):
+				if timeout is not None and time.monotonic() - start >= timeout:
+					f.close()
+					_record(self.filename, timeouts=1, retries=retries)
+					raise LockTimeout('Timed out locking {0}'.format(self.filename))
+
+				await asyncio.sleep(delay)
+				delay = min(delay * 2, self.POLL_MAX_s)
+				continue
+
+			done, f = self._locked(f, retries, start)
+			if done:
+				return f
+
+			retries += 1
+
+	def release(self):
+		if self.fileobj is None:
+			return
+
+		hold = time.monotonic() - self._acquired
+		_record(self.filename, hold_s=hold, hold_max_s=hold)
+
+		self.fileobj.close()
+		self.fileobj = None
+
+	def __enter__(self):
+		return self.acquire()
 
 	def __exit__(self, _exc_type, _exc_value, _traceback):
-		self.fileobj.close()
\ No newline at end of file
+		self.release()
+
+	async def __aenter__(self):
+		return await self.acquire_async()
+
+	async def __aexit__(self, _exc_type, _exc_value, _traceback):
+		self.release()
+
+	@staticmethod
+	def stats(filename=None):
+		''' Returns the contention metrics for filename, or for all files
+			keyed by absolute filename.
+		'''
+		with _stats_lock:
+			if filename is not None:
+				return dict(_stats.get(os.path.abspath(filename), {}))
+
+			return { k: dict(v) for k, v in _stats.items() }
+
+	@staticmethod
+	def reset_stats():
+		with _stats_lock:
+			_stats.clear()
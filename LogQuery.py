@@ -0,0 +1,327 @@
+''' Indexed queries over the Cme log files (PATHS.LOGDIR) and a streaming tail.
+
+	Log lines start with the asctime and level of the Logging formats, e.g.,
+	"2017-05-17 12:00:00,123 INFO     [cme] ...".  Lines that don't (e.g.,
+	traceback lines) belong to the entry above them.
+
+		from .common import LogQuery
+
+		for line in LogQuery.query(Config.LOGGING.HWLOG, start='2017-05-17 12:00:00', levels=['ERROR']):
+			...
+
+		for line in LogQuery.tail(Config.LOGGING.APILOG, follow=True):
+			...
+
+	query() covers the current log and its rotated segments (name.1, name.2.gz,
+	...), oldest first.  Each segment is indexed by block (the offset, first
+	timestamp and the levels present in every BLOCK_SIZE bytes) so a query
+	seeks to the blocks it needs instead of scanning.  Indexes are cached,
+	and the index of the live log is extended as it grows.
+'''
+import os, re, gzip, glob, bisect, select, ctypes, ctypes.util, threading, time
+from datetime import datetime
+
+BLOCK_SIZE = 32 * 1024
+
+# timestamp and level at the start of a log entry
+_ENTRY = re.compile(rb'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)[,.\d]* +([A-Z]+)\b')
+
+_LEVEL_BITS = { b'DEBUG': 1, b'INFO': 2, b'WARNING': 4, b'ERROR': 8, b'CRITICAL': 16 }
+
+
+def _level_mask(levels):
+	if not levels:
+		return 0xff
+
+	mask = 0
+	for level in levels:
+		mask |= _LEVEL_BITS.get(level.upper().encode(), 0)
+
+	return mask
+
+
+def _timestamp(t):
+	''' Query bound as sortable bytes ('YYYY-MM-DD HH:MM:SS').
+	'''
+	if t is None:
+		return None
+
+	if isinstance(t, datetime):
+		t = t.strftime('%Y-%m-%d %H:%M:%S')
+
+	return t.encode() if isinstance(t, str) else t
+
+
+def _open(path):
+	return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def segments(path):
+	''' Returns the log file and its rotated segments, oldest first.
+	'''
+	rotated = []
+	for p in glob.glob(glob.escape(path) + '.*'):
+		suffix = p[len(path) + 1:]
+		if suffix.endswith('.gz'):
+			suffix = suffix[:-3]
+
+		if suffix.isdigit():
+			rotated.append((int(suffix), p))
+
+	result = [ p for _, p in sorted(rotated, reverse=True) ]
+
+	if os.path.exists(path):
+		result.append(path)
+
+	return result
+
+
+class SegmentIndex(object):
+	''' Block index of one log segment.
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.ino = None
+		self.offsets = [] # block start offsets (uncompressed)
+		self.times = [] # first timestamp in each block
+		self.masks = [] # levels seen in each block
+		self.end = 0 # bytes indexed so far
+		self.block_end = 0 # end of the last block, which updates keep filling
+		self.level = 0 # level of the last entry (for its continuation lines)
+		self.last_time = None
+
+	def update(self):
+		''' Index anything new.  A replaced or truncated file is re-indexed.
+		'''
+		st = os.stat(self.path)
+
+		if st.st_ino != self.ino or (not self.path.endswith('.gz') and st.st_size < self.end):
+			self.__init__(self.path)
+			self.ino = st.st_ino
+
+		elif self.path.endswith('.gz') or st.st_size == self.end:
+			return self
+
+		with _open(self.path) as f:
+			f.seek(self.end)
+			offset = self.end
+
+			for line in f:
+				if not line.endswith(b'\n'):
+					break # partial line still being written, indexed next time
+
+				m = _ENTRY.match(line)
+
+				if offset >= self.block_end and m:
+					self.offsets.append(offset)
+					self.times.append(m.group(1))
+					self.masks.append(0)
+					self.block_end = offset + BLOCK_SIZE
+
+				if m:
+					self.level = _LEVEL_BITS.get(m.group(2), 0)
+					self.last_time = m.group(1)
+
+				if self.masks:
+					self.masks[-1] |= self.level
+
+				offset += len(line)
+
+			self.end = offset
+
+		return self
+
+	def blocks(self, start, mask):
+		''' Yields (offset, end offset) of the blocks that may hold entries
+			at or after start with a level in mask.
+		'''
+		first = 0
+		if start is not None:
+			first = max(bisect.bisect_right(self.times, start) - 1, 0)
+
+		for i in range(first, len(self.offsets)):
+			if self.masks[i] & mask:
+				end = self.offsets[i + 1] if i + 1 < len(self.offsets) else self.end
+				yield self.offsets[i], end
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def index(path):
+	''' Returns the (cached, updated) SegmentIndex of a log segment.
+	'''
+	with _indexes_lock:
+		idx = _indexes.get(path)
+		if idx is None:
+			idx = _indexes[path] = SegmentIndex(path)
+
+	idx.update()
+
+	# forget segments that have been rotated away
+	with _indexes_lock:
+		for p in [ p for p in _indexes if not os.path.exists(p) ]:
+			del _indexes[p]
+
+	return idx
+
+
+def query(path, start=None, end=None, levels=None):
+	''' Yields the lines (str, without the newline) of log entries from
+		start to end (datetimes or 'YYYY-MM-DD HH:MM:SS' strings, inclusive)
+		with one of the given levels (e.g., ['WARNING', 'ERROR']), across
+		the log and its rotated segments, oldest first.
+	'''
+	start, end = _timestamp(start), _timestamp(end)
+	mask = _level_mask(levels)
+
+	for segment in segments(path):
+		try:
+			idx = index(segment)
+		except OSError:
+			continue # rotated away while we looked
+
+		if not idx.times:
+			continue
+		if end is not None and idx.times[0] > end:
+			break
+		if start is not None and idx.last_time < start:
+			continue
+
+		with _open(segment) as f:
+			for offset, block_end in idx.blocks(start, mask):
+				f.seek(offset)
+				keep = False
+
+				for line in f:
+					offset += len(line)
+
+					m = _ENTRY.match(line)
+					if m:
+						t = m.group(1)
+						if end is not None and t > end:
+							return
+
+						keep = (start is None or t >= start) and bool(_LEVEL_BITS.get(m.group(2), 0) & mask)
+
+					if keep:
+						yield line.rstrip(b'\n').decode(errors='replace')
+
+					if offset >= block_end:
+						break
+
+
+# inotify (see inotify(7)), used by tail() when available
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+def _inotify(directory):
+	''' Returns an inotify fd watching directory, or None if unavailable.
+	'''
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if fd < 0:
+			return None
+
+		if libc.inotify_add_watch(fd, directory.encode(), IN_MODIFY | IN_MOVED_TO | IN_CREATE) < 0:
+			os.close(fd)
+			return None
+
+		return fd
+
+	except (OSError, AttributeError):
+		return None
+
+
+def _last_lines(f, n):
+	''' Seek f to the start of its last n lines.
+	'''
+	if n <= 0:
+		f.seek(0, os.SEEK_END)
+		return
+
+	size = f.seek(0, os.SEEK_END)
+	pos = size
+	found = 0
+
+	while pos > 0 and found <= n:
+		step = min(BLOCK_SIZE, pos)
+		pos -= step
+		f.seek(pos)
+		chunk = f.read(step)
+
+		# ignore a final newline, count the others
+		if pos + step == size and chunk.endswith(b'\n'):
+			chunk = chunk[:-1]
+
+		for i in range(len(chunk) - 1, -1, -1):
+			if chunk[i] == 0x0a:
+				found += 1
+				if found == n:
+					f.seek(pos + i + 1)
+					return
+
+	f.seek(0)
+
+
+def tail(path, lines=10, follow=False, poll=1.0):
+	''' Yields the last lines of a log (str, without the newline) and, with
+		follow, the lines added to it from then on - across rotations.
+		Waits on inotify (checking at least every poll seconds) or falls
+		back to polling.  Memory use is constant.
+	'''
+	f = open(path, 'rb')
+	_last_lines(f, lines)
+
+	watch = _inotify(os.path.dirname(os.path.abspath(path))) if follow else None
+	partial = b''
+
+	try:
+		while True:
+			for line in f:
+				if not line.endswith(b'\n'):
+					partial += line
+					break
+
+				yield (partial + line).rstrip(b'\n').decode(errors='replace')
+				partial = b''
+
+			if not follow:
+				if partial:
+					yield partial.decode(errors='replace')
+				return
+
+			# log rotated (new file at path) or truncated?
+			try:
+				st = os.stat(path)
+			except OSError:
+				st = None
+
+			if st is not None and (st.st_ino != os.fstat(f.fileno()).st_ino or st.st_size < f.tell()):
+				for line in f:
+					yield (partial + line).rstrip(b'\n').decode(errors='replace')
+					partial = b''
+
+				f.close()
+				f = open(path, 'rb')
+				partial = b''
+				continue
+
+			if watch is not None:
+				if select.select([ watch ], [], [], poll)[0]:
+					try:
+						while os.read(watch, 4096):
+							pass
+					except BlockingIOError:
+						pass
+			else:
+				time.sleep(poll)
+
+	finally:
+		f.close()
+		if watch is not None:
+			os.close(watch)
@@ -1,6 +1,361 @@
-import os, sys, logging, logging.handlers
+import os, sys, glob, gzip, shutil, time, queue, atexit, threading, logging, logging.handlers
 
-''' 
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+	''' QueueHandler for a bounded queue.  When the queue is full, records
+		are dropped (and counted) rather than blocking the caller.  Once
+		direct is set (the queue's listener has stopped) records are
+		handed straight to target instead.
+	'''
+	def __init__(self, q, target=None):
+		super().__init__(q)
+		self.dropped = 0
+		self.target = target
+		self.direct = False
+
+	def emit(self, record):
+		if self.direct:
+			self.target.handle(record)
+		else:
+			super().emit(record)
+
+	def prepare(self, record):
+		# The queue stays in this process, so rather than copying and
+		# formatting the record (the QueueHandler default) only merge
+		# its args now; the listener's handlers do the formatting.
+		record.msg = record.getMessage()
+		record.args = None
+		return record
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+
+class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+	''' RotatingFileHandler that gzips rotated files (name.1.gz, name.2.gz,
+		...) on a background thread, keeps the total size of the log folder
+		within budget bytes (removing the oldest compressed files first),
+		and writes through a large buffer flushed at most every
+		flush_interval seconds (the background thread flushes idle logs).
+	'''
+	BUFFER_SIZE = 64 * 1024
+
+	def __init__(self, filename, maxBytes=0, backupCount=0, budget=None, flush_interval=1.0):
+		self.budget = budget
+		self.flush_interval = flush_interval
+		self._flushed = time.monotonic()
+		self._in_emit = False
+		self._compressing = None # threading.Event of the pending compression
+		self._size = 0 # bytes in the current file (counted, not stat'ed)
+		self._record_size = 0
+
+		super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount)
+
+		_worker.register(self)
+
+	def _open(self):
+		stream = open(self.baseFilename, self.mode, buffering=self.BUFFER_SIZE, encoding=self.encoding, errors=self.errors)
+		self._size = stream.tell()
+		return stream
+
+	def shouldRollover(self, record):
+		# The default seeks to the end of the stream to find its size, which
+		# flushes the buffer on every record, so the size is counted instead.
+		if self.stream is None:
+			self.stream = self._open()
+
+		if self.maxBytes <= 0:
+			self._record_size = 0
+			return False
+
+		self._record_size = len(self.format(record)) + len(self.terminator)
+
+		return self._size > 0 and self._size + self._record_size >= self.maxBytes
+
+	def namer(self, name):
+		return name + '.gz'
+
+	def rotator(self, source, dest):
+		# rename now (cheap), compress later on the worker thread
+		pending = dest[:-len('.gz')]
+		os.rename(source, pending)
+
+		self._compressing = threading.Event()
+		_worker.submit(self._compress, pending, dest, self._compressing)
+
+	def doRollover(self):
+		# the previous compression has to finish before the .gz files shift
+		if self._compressing is not None:
+			self._compressing.wait()
+
+		super().doRollover()
+
+	def _compress(self, pending, dest):
+		with open(pending, 'rb') as src, gzip.open(dest + '.tmp', 'wb') as dst:
+			shutil.copyfileobj(src, dst)
+
+		os.replace(dest + '.tmp', dest)
+		os.remove(pending)
+
+		if self.budget:
+			enforce_budget(os.path.dirname(self.baseFilename), self.budget)
+
+	def emit(self, record):
+		self._in_emit = True
+		try:
+			super().emit(record) # may roll over (and reset _size) first
+			self._size += self._record_size
+		finally:
+			self._in_emit = False
+
+	def flush(self):
+		# flushes requested by emit() are batched up to flush_interval
+		if self._in_emit and time.monotonic() - self._flushed < self.flush_interval:
+			return
+
+		super().flush()
+		self._flushed = time.monotonic()
+
+	def close(self):
+		_worker.unregister(self)
+		super().close()
+
+
+def enforce_budget(logdir, budget):
+	''' Remove the oldest compressed logs until the files in logdir total
+		no more than budget bytes.
+	'''
+	files = [ f for f in glob.glob(os.path.join(logdir, '*')) if os.path.isfile(f) ]
+	total = sum(os.path.getsize(f) for f in files)
+
+	for f in sorted((f for f in files if f.endswith('.gz')), key=os.path.getmtime):
+		if total <= budget:
+			break
+
+		total -= os.path.getsize(f)
+		os.remove(f)
+
+
+class _Worker(object):
+	''' Background thread that compresses rotated logs and flushes the
+		buffered CompressedRotatingFileHandlers.
+	'''
+	def __init__(self):
+		self.jobs = queue.Queue()
+		self.handlers = set()
+		self.lock = threading.Lock()
+		self.thread = None
+
+	def register(self, handler):
+		with self.lock:
+			self.handlers.add(handler)
+
+			if self.thread is None:
+				self.thread = threading.Thread(target=self.run, daemon=True)
+				self.thread.start()
+
+	def unregister(self, handler):
+		with self.lock:
+			self.handlers.discard(handler)
+
+	def submit(self, fn, pending, dest, done):
+		self.jobs.put((fn, pending, dest, done))
+
+	def run(self):
+		while True:
+			try:
+				fn, pending, dest, done = self.jobs.get(timeout=0.5)
+			except queue.Empty:
+				self.flush()
+				continue
+
+			try:
+				fn(pending, dest)
+			except Exception:
+				pass
+			finally:
+				done.set()
+
+	def flush(self):
+		with self.lock:
+			handlers = list(self.handlers)
+
+		now = time.monotonic()
+		for h in handlers:
+			if now - h._flushed >= h.flush_interval:
+				h.acquire()
+				try:
+					h.flush()
+				finally:
+					h.release()
+
+_worker = _Worker()
+
+
+class RepeatFilter(logging.Filter):
+	''' Handler filter that collapses runs of a repeated message and rate
+		limits the records of the logger name (and of its children).
+
+		A message identical to the one before it from the same logger is
+		suppressed; when a different message arrives (or every interval
+		seconds while the run continues) a "last message repeated N times"
+		record is logged first.  With rate (records per second, bursts of
+		up to burst records) a token bucket drops records beyond the rate,
+		logging a summary of how many were dropped once records are let
+		through again.
+
+		The filter goes on handlers, which also see the records propagated
+		from child loggers, and may go on several (e.g., file and console):
+		each record is judged once and the verdict reused by the others.
+
+		Suppressed records are counted in repeated and rate_limited.
+	'''
+	def __init__(self, name='', rate=None, burst=10, interval=60.0):
+		super().__init__(name)
+		self.rate = rate
+		self.burst = burst
+		self.interval = interval
+
+		self.repeated = 0
+		self.rate_limited = 0
+
+		self._lock = threading.Lock()
+		self._last = {} # logger name -> [message, levelno, repeats, time of last summary]
+		self._tokens = burst
+		self._stamp = time.monotonic()
+		self._dropped = 0
+
+	def stats(self):
+		return { 'repeated': self.repeated, 'rate_limited': self.rate_limited }
+
+	def filter(self, record):
+		if getattr(record, 'summary', False) or not super().filter(record):
+			return True # not one of ours
+
+		verdicts = record.__dict__.setdefault('_repeat_verdicts', {})
+		if self not in verdicts:
+			verdicts[self] = self._judge(record)
+
+		return verdicts[self]
+
+	def _judge(self, record):
+		summaries = []
+		message = record.getMessage()
+		now = time.monotonic()
+
+		with self._lock:
+			last = self._last.get(record.name)
+
+			if last and last[0] == message and last[1] == record.levelno:
+				if now - last[3] < self.interval:
+					last[2] += 1
+					self.repeated += 1
+					return False
+
+			if last and last[2]:
+				summaries.append((last[1], 'Last message repeated {0} times'.format(last[2])))
+
+			if last and last[0] == message:
+				last[2], last[3] = 0, now
+			else:
+				self._last[record.name] = [ message, record.levelno, 0, now ]
+
+			if self.rate:
+				self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+				self._stamp = now
+
+				if self._tokens < 1:
+					self._dropped += 1
+					self.rate_limited += 1
+					return False
+
+				self._tokens -= 1
+
+				if self._dropped:
+					summaries.append((logging.WARNING, '{0} messages suppressed by rate limit'.format(self._dropped)))
+					self._dropped = 0
+
+		# log the summaries (they pass this filter) ahead of this record,
+		# through the same handlers
+		for level, msg in summaries:
+			summary = logging.LogRecord(record.name, level, record.pathname, record.lineno, msg, None, None)
+			summary.summary = True
+			logging.getLogger(record.name).handle(summary)
+
+		return True
+
+
+class _Listener(logging.handlers.QueueListener):
+	''' QueueListener whose stop sentinel waits for room in a full queue
+		(the default put_nowait raises queue.Full).
+	'''
+	def enqueue_sentinel(self):
+		self.queue.put(self._sentinel)
+
+
+class _Sink(object):
+	''' One output (a log file or the console) shared by every logger that
+		writes to it.  Loggers attach the sink's entry handler: the output
+		handler itself, or in async mode a DroppingQueueHandler whose
+		QueueListener thread drives the output handler.
+	'''
+	def __init__(self, handler, async_queue_size=None):
+		self.handler = handler
+		self.entry = handler
+		self.listener = None
+
+		if async_queue_size:
+			self.entry = DroppingQueueHandler(queue.Queue(async_queue_size), handler)
+			self.listener = _Listener(self.entry.queue, handler)
+			self.listener.start()
+
+	def stop(self):
+		if self.listener:
+			# later records are written synchronously (the handler has its
+			# own lock) while the listener writes out what's queued
+			self.entry.direct = True
+			self.listener.stop()
+			self.listener = None
+
+		self.handler.flush()
+
+	def close(self):
+		self.stop()
+		self.handler.close()
+
+
+# Registry of sinks (keyed by absolute log file path, or CONSOLE), of
+# the sinks each named logger is attached to and of their RepeatFilters
+CONSOLE = '<stdout>'
+
+_sinks = {}
+_loggers = {}
+_filters = {}
+_registry_lock = threading.RLock()
+
+
+def Shutdown():
+	''' Stop the async logging threads once their queued records have been
+		written.  Call this from the SIGTERM cleanup (it also runs at exit);
+		anything logged afterwards is written synchronously.
+	'''
+	with _registry_lock:
+		for sink in _sinks.values():
+			sink.stop()
+
+atexit.register(Shutdown)
+
+
+def SetLevel(name, level):
+	''' Change the level (e.g., 'INFO') of a logger from GetLogger.
+	'''
+	logging.getLogger(name).setLevel(logging.getLevelName(level))
+
+
+'''
 config: {
 	'REMOVE_PREVIOUS': False,
 	'PATH': '/data/log/cme-boot.log',
@@ -9,51 +364,163 @@ config: {
 	'FORMAT': '%(asctime)s %(levelname)-8s [%(name)s] %(message)s',
 	'DATE': '%Y-%m-%d %H:%M:%S',
 	'LEVEL': 'DEBUG',
-	'CONSOLE': False
+	'CONSOLE': False,
+	'ASYNC': False,
+	'QUEUE_SIZE': 1000,
+	'COMPRESS': False,
+	'BUDGET': 4194304,
+	'FLUSH_INTERVAL': 1.0,
+	'DEDUPE': False,
+	'RATE': None,
+	'BURST': 10
 }
+
+With ASYNC, log calls only put the record on a queue (of up to QUEUE_SIZE
+records, further records are dropped and counted on the sink's
+DroppingQueueHandler) and a QueueListener thread does the file and
+console writes.
+
+With COMPRESS, a CompressedRotatingFileHandler gzips rotated files in the
+background, keeps the log folder within BUDGET bytes and buffers writes
+for up to FLUSH_INTERVAL seconds.
+
+With DEDUPE (or a RATE), a RepeatFilter on the logger's handlers
+collapses repeated messages of the logger and its children and, with
+RATE, limits them to RATE records per second (bursts of up to BURST).
+GetFilter(name) returns it for its counters.
+
+Loggers are kept in a registry: calling GetLogger again for the same
+name reconfigures the logger (level, format, file size/count, console)
+without adding handlers, and all loggers logging to the same PATH (or
+to the console) share one handler.  ASYNC and REMOVE_PREVIOUS only
+apply when a file's handler is first created.
 '''
 def GetLogger(name, config):
 
-	# delete previous if configured and exists
-	if config['REMOVE_PREVIOUS']:
-		try:
-			os.remove(config['PATH'])
-		except:
-			pass
-
-	# create a logger by name
-	logger = logging.getLogger(name)
-
-	# set the logging level
-	level = logging.getLevelName(config['LEVEL'])
-	
-	# set the logger level to lowest level (DEBUG)
-	# and use the handler levels to set the desired
-	# level from the config see: http://stackoverflow.com/a/11111212
-	logger.setLevel(logging.DEBUG)
-
-	# use rotating file handler
-	fh = logging.handlers.RotatingFileHandler(config['PATH'], maxBytes=config['SIZE'], backupCount=config['COUNT'])
-	fh.setLevel(level)
-
-	# a nice format for log entries
-	formatter = None
-	if config.get('FORMAT'):
-		if config.get('DATE'):
-			formatter = logging.Formatter(config['FORMAT'], datefmt=config['DATE'])
+	with _registry_lock:
+
+		# create a logger by name
+		logger = logging.getLogger(name)
+
+		# The level is set on the logger, rather than on its handlers, as
+		# the handlers may be shared with loggers configured differently.
+		logger.setLevel(logging.getLevelName(config['LEVEL']))
+
+		# a nice format for log entries
+		formatter = None
+		if config.get('FORMAT'):
+			if config.get('DATE'):
+				formatter = logging.Formatter(config['FORMAT'], datefmt=config['DATE'])
+			else:
+				formatter = logging.Formatter(config['FORMAT'])
+
+		sinks = [ _file_sink(config) ]
+
+		if config['CONSOLE']:
+			sinks.append(_console_sink(config))
+
+		for sink in sinks:
+			if formatter:
+				sink.handler.setFormatter(formatter)
+
+		# repeated message / rate limit filter (reconfigured in place)
+		repeat = _filters.get(name)
+
+		if config.get('DEDUPE') or config.get('RATE'):
+			if repeat is None:
+				repeat = _filters[name] = RepeatFilter(logger.name if logger.parent else '')
+
+			repeat.rate = config.get('RATE')
+			repeat.burst = config.get('BURST', 10)
+
+		elif repeat is not None:
+			del _filters[name]
+
+		# swap this logger over to its (possibly new) set of sinks
+		for sink in _loggers.get(name, []):
+			if sink not in sinks:
+				logger.removeHandler(sink.entry)
+				sink.entry.removeFilter(repeat)
+
+		for sink in sinks:
+			if sink.entry not in logger.handlers:
+				logger.addHandler(sink.entry)
+
+			# the filter is on the handlers so that it also sees records
+			# propagated from child loggers
+			if repeat is not None and name in _filters:
+				sink.entry.addFilter(repeat)
+			else:
+				sink.entry.removeFilter(repeat)
+
+		_loggers[name] = sinks
+
+		_close_unused()
+
+		return logger
+
+
+def GetFilter(name):
+	''' Returns the RepeatFilter of a logger from GetLogger (or None).
+	'''
+	with _registry_lock:
+		return _filters.get(name)
+
+
+def _file_sink(config):
+	path = os.path.abspath(config['PATH'])
+	sink = _sinks.get(path)
+
+	if sink is None:
+		# delete previous if configured and exists
+		if config['REMOVE_PREVIOUS']:
+			try:
+				os.remove(path)
+			except:
+				pass
+
+		# the log folder is no longer created when Config is imported
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+
+		# use rotating file handler
+		if config.get('COMPRESS'):
+			fh = CompressedRotatingFileHandler(path, maxBytes=config['SIZE'], backupCount=config['COUNT'],
+				budget=config.get('BUDGET'), flush_interval=config.get('FLUSH_INTERVAL', 1.0))
 		else:
-			formatter = logging.Formatter(config['FORMAT'])
+			fh = logging.handlers.RotatingFileHandler(path, maxBytes=config['SIZE'], backupCount=config['COUNT'])
+
+		sink = _sinks[path] = _Sink(fh, _queue_size(config))
+
+	else:
+		sink.handler.maxBytes = config['SIZE']
+		sink.handler.backupCount = config['COUNT']
+
+		if isinstance(sink.handler, CompressedRotatingFileHandler):
+			sink.handler.budget = config.get('BUDGET')
+			sink.handler.flush_interval = config.get('FLUSH_INTERVAL', 1.0)
+
+	return sink
+
+
+def _console_sink(config):
+	sink = _sinks.get(CONSOLE)
+
+	if sink is None:
+		sink = _sinks[CONSOLE] = _Sink(logging.StreamHandler(sys.stdout), _queue_size(config))
+
+	return sink
+
 
-		fh.setFormatter(formatter)
+def _queue_size(config):
+	return config.get('QUEUE_SIZE', 1000) if config.get('ASYNC') else None
 
-	logger.addHandler(fh)
 
-	if config['CONSOLE']:
-		sh = logging.StreamHandler(sys.stdout)
-		sh.setLevel(level)
+def _close_unused():
+	used = set()
+	for sinks in _loggers.values():
+		used.update(id(s) for s in sinks)
 
-		if formatter: sh.setFormatter(formatter)
-		
-		logger.addHandler(sh)
-	
-	return logger
+	for key, sink in list(_sinks.items()):
+		if id(sink) not in used:
+			sink.close()
+			del _sinks[key]
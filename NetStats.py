@@ -0,0 +1,109 @@
+''' Network interface traffic counters and rates.
+
+	All interfaces' counters are read from /proc/net/dev in one read (rather
+	than eight sysfs files per interface) and kept in a fixed-size ring of
+	samples, so sampling costs one small read and an append.
+
+		from .common.NetStats import Sampler
+
+		sampler = Sampler(size=60).start(interval=1.0)
+		...
+		sampler.rates('eth0') # { 'rx_bytes': 1234.5, ... } per second
+		sampler.stop()
+'''
+import threading, time
+from collections import deque, namedtuple
+
+NET_DEV = '/proc/net/dev'
+
+Counters = namedtuple('Counters', 'rx_bytes rx_packets rx_errors rx_dropped tx_bytes tx_packets tx_errors tx_dropped')
+
+# /proc/net/dev columns of the Counters fields
+_COLUMNS = (0, 1, 2, 3, 8, 9, 10, 11)
+
+
+def read_counters(path=NET_DEV):
+	''' Returns the Counters of every interface, keyed by name.
+	'''
+	with open(path) as f:
+		lines = f.read().splitlines()[2:]
+
+	result = {}
+	for line in lines:
+		name, _, values = line.partition(':')
+		values = values.split()
+		result[name.strip()] = Counters._make(int(values[i]) for i in _COLUMNS)
+
+	return result
+
+
+class Sampler(object):
+	''' Keeps the last size samples of read_counters() (a deque of
+		(monotonic time, counters)) and computes rates from them.
+		sample() may be called directly or from start()'s thread.
+	'''
+	def __init__(self, size=60, path=NET_DEV):
+		self.path = path
+		self.samples = deque(maxlen=size)
+
+		self._stop = threading.Event()
+		self._thread = None
+
+	def sample(self):
+		self.samples.append((time.monotonic(), read_counters(self.path)))
+
+	def rates(self, iface, window=1):
+		''' Returns the per second rates of an interface's counters over the
+			last window sample intervals (as Counters of floats), or None if
+			there aren't enough samples.  Counters that were reset (e.g., the
+			interface was re-created) give 0.
+		'''
+		samples = self.samples
+		if len(samples) < 2:
+			return None
+
+		window = min(window, len(samples) - 1)
+		t0, old = samples[-1 - window]
+		t1, new = samples[-1]
+
+		if iface not in old or iface not in new or t1 <= t0:
+			return None
+
+		dt = t1 - t0
+		return Counters._make(max(b - a, 0) / dt for a, b in zip(old[iface], new[iface]))
+
+	def all_rates(self, window=1):
+		''' rates() of every interface in the latest sample, keyed by name.
+		'''
+		if not self.samples:
+			return {}
+
+		result = {}
+		for iface in self.samples[-1][1]:
+			rates = self.rates(iface, window)
+			if rates is not None:
+				result[iface] = rates
+
+		return result
+
+	def start(self, interval=1.0):
+		''' Sample every interval seconds on a background thread.  Returns self.
+		'''
+		if self._thread is None:
+			self._stop.clear()
+			self._thread = threading.Thread(target=self._run, args=(interval,), name='NetStats', daemon=True)
+			self._thread.start()
+
+		return self
+
+	def stop(self):
+		if self._thread is not None:
+			self._stop.set()
+			self._thread.join()
+			self._thread = None
+
+	def _run(self, interval):
+		while True:
+			self.sample()
+			if self._stop.wait(interval):
+				return
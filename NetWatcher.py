@@ -0,0 +1,197 @@
+''' Event-driven network change notifications (rtnetlink, see rtnetlink(7)).
+
+	A NetWatcher subscribes to the kernel's link, IPv4 address and IPv4 route
+	multicast groups and reports each change as a NetEvent to a callback
+	and/or an asyncio queue.  The IpUtils snapshot is invalidated (or
+	re-read, with refresh=True) before anyone is notified, so readers always
+	see the new state.  The watcher thread sleeps in select() while the
+	network is idle.
+
+		from .common.NetWatcher import NetWatcher
+
+		watcher = NetWatcher(callback=lambda e: logger.info(e)).start()
+		...
+		watcher.stop()
+
+		# or, from a coroutine
+		queue = asyncio.Queue()
+		watcher = NetWatcher(queue=queue).start()
+		event = await queue.get()
+'''
+import os, errno, socket, struct, select, threading, asyncio, logging
+from collections import namedtuple
+
+from . import IpUtils
+
+# multicast groups
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+# message types we report: type -> (kind, added)
+_EVENTS = {
+	16: ('link', True), 17: ('link', False), # RTM_NEWLINK, RTM_DELLINK
+	20: ('address', True), 21: ('address', False), # RTM_NEWADDR, RTM_DELADDR
+	24: ('route', True), 25: ('route', False) # RTM_NEWROUTE, RTM_DELROUTE
+}
+
+_NLMSGHDR = struct.Struct('=LHHLL') # length, type, flags, seq, pid
+_IFINFOMSG = struct.Struct('=BxHiII') # family, type, index, flags, change
+_IFADDRMSG = struct.Struct('=BBBBI') # family, prefixlen, flags, scope, index
+_RTMSG = struct.Struct('=BBBBBBBBI') # family, dst_len, src_len, tos, table, protocol, scope, type, flags
+_RTATTR = struct.Struct('=HH') # length, type
+
+RTA_OIF = 4
+
+# kind is 'link', 'address', 'route' or 'overrun' (events were lost, re-read everything)
+NetEvent = namedtuple('NetEvent', 'kind added index iface')
+
+
+def _align(n):
+	return (n + 3) & ~3
+
+
+def _route_oif(payload):
+	''' Output interface index of a route message, or None.
+	'''
+	pos = _align(_RTMSG.size)
+	while pos + _RTATTR.size <= len(payload):
+		length, kind = _RTATTR.unpack_from(payload, pos)
+		if length < _RTATTR.size:
+			break
+
+		if kind == RTA_OIF:
+			return struct.unpack_from('=I', payload, pos + _RTATTR.size)[0]
+
+		pos += _align(length)
+
+	return None
+
+
+def parse(data):
+	''' Returns the NetEvents in a netlink datagram.
+	'''
+	events = []
+	pos = 0
+
+	while pos + _NLMSGHDR.size <= len(data):
+		length, kind, _, _, _ = _NLMSGHDR.unpack_from(data, pos)
+		if length < _NLMSGHDR.size:
+			break
+
+		payload = data[pos + _NLMSGHDR.size:pos + length]
+		pos += _align(length)
+
+		if kind not in _EVENTS:
+			continue
+
+		if kind in (16, 17):
+			index = _IFINFOMSG.unpack_from(payload)[2]
+		elif kind in (20, 21):
+			index = _IFADDRMSG.unpack_from(payload)[4]
+		else:
+			index = _route_oif(payload)
+
+		try:
+			iface = socket.if_indextoname(index) if index else None
+		except OSError:
+			iface = None # already gone
+
+		events.append(NetEvent(_EVENTS[kind][0], _EVENTS[kind][1], index, iface))
+
+	return events
+
+
+class NetWatcher(object):
+	''' Watches rtnetlink for network changes, see the module docstring.
+
+		callback(event) is called on the watcher thread; events put on queue
+		(an asyncio.Queue) are handed to its event loop (loop, or the loop
+		current when the watcher is created).
+	'''
+	GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE
+
+	def __init__(self, callback=None, queue=None, loop=None, refresh=False, groups=None):
+		self.callback = callback
+		self.queue = queue
+		self.loop = loop
+		self.refresh = refresh
+		self.groups = self.GROUPS if groups is None else groups
+
+		if queue is not None and loop is None:
+			self.loop = asyncio.get_event_loop()
+
+		self._sock = None
+		self._wake = None
+		self._thread = None
+		self._logger = logging.getLogger(__name__)
+
+	def start(self):
+		''' Subscribe and start watching.  Raises OSError if netlink isn't
+			available.  Returns self.
+		'''
+		if self._thread is not None:
+			return self
+
+		self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+		self._sock.bind((0, self.groups))
+		self._wake = os.pipe()
+
+		self._thread = threading.Thread(target=self._watch, name='NetWatcher', daemon=True)
+		self._thread.start()
+
+		return self
+
+	def stop(self):
+		if self._thread is None:
+			return
+
+		os.write(self._wake[1], b'x')
+		self._thread.join()
+		self._thread = None
+
+		self._sock.close()
+		for fd in self._wake:
+			os.close(fd)
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, _exc_type, _exc_value, _traceback):
+		self.stop()
+
+	def _watch(self):
+		while True:
+			ready = select.select([ self._sock, self._wake[0] ], [], [])[0]
+			if self._wake[0] in ready:
+				return
+
+			try:
+				events = parse(self._sock.recv(65536))
+			except OSError as e:
+				if e.errno != errno.ENOBUFS:
+					raise
+
+				# the kernel dropped messages for us
+				events = [ NetEvent('overrun', None, None, None) ]
+
+			if events:
+				self._notify(events)
+
+	def _notify(self, events):
+		IpUtils.invalidate_snapshot()
+		if self.refresh:
+			try:
+				IpUtils.network_snapshot()
+			except OSError:
+				pass # interface is mid-change, next reader retries
+
+		for event in events:
+			if self.callback is not None:
+				try:
+					self.callback(event)
+				except Exception:
+					self._logger.exception('NetWatcher callback failed')
+
+			if self.queue is not None:
+				self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
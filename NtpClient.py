@@ -0,0 +1,234 @@
+''' Native NTP queries: the ntpd mode 6 control protocol (what ntpq uses, see
+	RFC 1305 appendix B) and a simple SNTP (RFC 4330) offset probe.
+
+		from .common import NtpClient
+
+		peers = NtpClient.peers() # [ ClockUtils.NtpPeer, ... ] as "ntpq -pn"
+		probe = NtpClient.sntp_offset('time.nist.gov')
+
+	Both raise OSError (e.g., socket.timeout, ConnectionRefusedError) if the
+	server doesn't answer, and NtpError if it refuses a request.
+'''
+import os, re, socket, struct, time
+from collections import namedtuple
+
+from .ClockUtils import NtpPeer
+
+NTP_PORT = 123
+
+# seconds between the NTP (1900) and unix (1970) epochs
+NTP_DELTA = 2208988800
+
+# mode 6 header: li/vn/mode, r/e/m/opcode, sequence, status, association, offset, count
+_CONTROL = struct.Struct('!BBHHHHH')
+
+CTL_OP_READSTAT = 1
+CTL_OP_READVAR = 2
+
+CTL_RESPONSE = 0x80
+CTL_ERROR = 0x40
+CTL_MORE = 0x20
+CTL_OP_MASK = 0x1f
+
+# peer selection status (status word bits 8-10) as the ntpq tally code
+_TALLY = ' x.-+#*o'
+
+# name=value pairs of a READVAR response (values may be quoted)
+_VARIABLE = re.compile(r'\s*([^=,\s]+)(?:=("[^"]*"|[^,]*))?,?')
+
+# SNTP packet: li/vn/mode, stratum, poll, precision, root delay, root dispersion,
+# reference id, then the reference, originate, receive and transmit timestamps
+_SNTP = struct.Struct('!BBbbII4sQQQQ')
+
+SntpResult = namedtuple('SntpResult', 'server stratum offset delay')
+
+
+class NtpError(Exception):
+	''' The server answered a request with an error.
+	'''
+	pass
+
+
+def _ntp_time(t):
+	''' unix time as a 64-bit NTP timestamp.
+	'''
+	return int((t + NTP_DELTA) * (1 << 32)) & 0xffffffffffffffff
+
+
+def _unix_time(ts):
+	return ts / (1 << 32) - NTP_DELTA
+
+
+def parse_variables(data):
+	''' Returns the name, value pairs of a READVAR response as a dict.
+	'''
+	variables = {}
+
+	for m in _VARIABLE.finditer(data.decode('ascii', errors='replace')):
+		value = m.group(2) or ''
+		if value.startswith('"'):
+			value = value[1:-1]
+
+		variables[m.group(1)] = value.strip()
+
+	return variables
+
+
+class NtpControl(object):
+	''' A mode 6 control session with an ntpd (the local one by default).
+	'''
+	VERSION = 2
+
+	def __init__(self, host='127.0.0.1', port=NTP_PORT, timeout=0.5):
+		self.timeout = timeout
+		self._sequence = os.getpid() & 0xffff
+
+		self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self._sock.settimeout(timeout)
+		self._sock.connect((host, port))
+
+	def close(self):
+		self._sock.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, _exc_type, _exc_value, _traceback):
+		self.close()
+
+	def request(self, opcode, association=0, data=b''):
+		''' Send a request and return the (status, data) of the response,
+			with its fragments put back together.
+		'''
+		self._sequence = (self._sequence + 1) & 0xffff
+		sequence = self._sequence
+
+		packet = _CONTROL.pack((self.VERSION << 3) | 6, opcode, sequence, 0, association, 0, len(data)) + data
+		self._sock.send(packet + b'\x00' * (-len(packet) % 4))
+
+		deadline = time.monotonic() + self.timeout
+		fragments = {}
+		end = None
+		status = 0
+
+		while end is None or sum(len(f) for f in fragments.values()) < end:
+			self._sock.settimeout(max(deadline - time.monotonic(), 0.001))
+			reply = self._sock.recv(4096)
+
+			if len(reply) < _CONTROL.size:
+				continue
+
+			_, flags, seq, status, assoc, offset, count = _CONTROL.unpack_from(reply)
+			if seq != sequence or not flags & CTL_RESPONSE or flags & CTL_OP_MASK != opcode:
+				continue # not ours (a late reply to an old request)
+
+			if flags & CTL_ERROR:
+				raise NtpError('ntpd error {0} for opcode {1}'.format(status >> 8, opcode))
+
+			fragments[offset] = reply[_CONTROL.size:_CONTROL.size + count]
+			if not flags & CTL_MORE:
+				end = offset + count
+
+		return status, b''.join(fragments[k] for k in sorted(fragments))
+
+	def readstat(self):
+		''' Returns the (association id, peer status word) of every peer.
+		'''
+		_, data = self.request(CTL_OP_READSTAT)
+
+		return [ struct.unpack_from('!HH', data, i) for i in range(0, len(data) - 3, 4) ]
+
+	def readvar(self, association=0):
+		''' Returns the variables of a peer (or of the system, 0) as a dict of strings.
+		'''
+		_, data = self.request(CTL_OP_READVAR, association)
+
+		return parse_variables(data)
+
+	def peers(self):
+		''' Returns the peers as "ntpq -pn" shows them (ClockUtils.NtpPeer).
+		'''
+		now = time.time()
+		peers = []
+
+		for association, status in self.readstat():
+			v = self.readvar(association)
+			peers.append(_peer(v, status, now))
+
+		return peers
+
+
+def _int(value, default=None, base=10):
+	try:
+		return int(value, base)
+	except (TypeError, ValueError):
+		return default
+
+
+def _float(value):
+	try:
+		return float(value)
+	except (TypeError, ValueError):
+		return None
+
+
+def _peer(v, status, now):
+	''' NtpPeer from a peer's READVAR variables, as ntpq computes the columns.
+	'''
+	remote = v.get('srcadr', '')
+	reach = _int(v.get('reach'), 0, 16)
+
+	# 'when' is the time since the last packet received (hex NTP timestamp)
+	when = None
+	rec = v.get('rec') or v.get('reftime')
+	if rec and reach:
+		seconds = _int(rec.split('.')[0], 0, 16)
+		if seconds:
+			when = max(int(now + NTP_DELTA - seconds), 0)
+
+	polls = [ p for p in (_int(v.get('hpoll')), _int(v.get('ppoll'))) if p ]
+	poll = 1 << min(polls) if polls else None
+
+	kind = 'l' if remote.startswith('127.127.') else 'u'
+
+	return NtpPeer(_TALLY[(status >> 8) & 7], remote, v.get('refid', ''),
+		_int(v.get('stratum'), 16), kind, when, poll, reach,
+		_float(v.get('delay')), _float(v.get('offset')), _float(v.get('jitter')))
+
+
+def peers(host='127.0.0.1', port=NTP_PORT, timeout=0.5):
+	''' Returns the peers of an ntpd (see NtpControl.peers).
+	'''
+	with NtpControl(host, port, timeout) as control:
+		return control.peers()
+
+
+def sntp_offset(server, port=NTP_PORT, timeout=1.0):
+	''' Query an NTP server once and return an SntpResult, with the offset of
+		the local clock from it and the round trip delay in seconds.
+	'''
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+		sock.settimeout(timeout)
+		sock.connect((server, port))
+
+		t1 = time.time()
+		sent = _ntp_time(t1)
+		sock.send(_SNTP.pack((4 << 3) | 3, 0, 0, 0, 0, 0, b'\x00' * 4, 0, 0, 0, sent))
+
+		while True:
+			reply = sock.recv(1024)
+			t4 = time.time()
+
+			if len(reply) < _SNTP.size:
+				continue
+
+			mode, stratum, _, _, _, _, _, _, originate, receive, transmit = _SNTP.unpack_from(reply)
+			if mode & 7 == 4 and originate == sent:
+				break
+
+	if stratum == 0:
+		raise NtpError('{0} sent a kiss-o\'-death'.format(server))
+
+	t2, t3 = _unix_time(receive), _unix_time(transmit)
+
+	return SntpResult(server, stratum, ((t2 - t1) + (t3 - t4)) / 2, (t4 - t1) - (t3 - t2))
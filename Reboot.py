@@ -1,9 +1,9 @@
-import os, subprocess, time, logging
+import os, time, logging
 
 from .ClockUtils import ntp_servers
 from .IpUtils import set_dhcp, write_network_addresses
 
-from . import is_a_cme, is_a_docker, docker_run, Config
+from . import is_a_cme, run_batch, Config
 
 def restart(power_off=False, recovery_mode=False, factory_reset=False, logger=None):
 	''' Performs a reboot with optional configuration (including network and clock) reset.
@@ -30,6 +30,9 @@ def restart(power_off=False, recovery_mode=False, factory_reset=False, logger=No
 
 	delay = Config.RECOVERY.RESET_REBOOT_DELAY_SECONDS
 
+	# host commands to run just before the reboot command
+	host_commands = []
+
 	# Handle factory reset
 	if factory_reset and settings_file and os.path.isfile(settings_file):
 		try:
@@ -57,15 +60,13 @@ def restart(power_off=False, recovery_mode=False, factory_reset=False, logger=No
 				logger.info("CME network settings reset to factory defaults")
 			
 			ntp_servers(['time.nist.gov'])
-			ntp_enable = ['systemctl', 'enable', 'ntp']
-			if is_a_docker():
-				docker_run(ntp_enable)
-			else:
-				subprocess.call(ntp_enable)
+
+			# enabled along with the reboot command in one host round trip
+			host_commands.append(['systemctl', 'enable', 'ntp'])
 
 			if logger:
 				logger.info("CME NTP servers set to factory defaults")
-				logger.info("CME NTP system enabled")
+				logger.info("CME NTP system will be enabled")
 
 		
 	# Handle recovery mode
@@ -86,10 +87,10 @@ def restart(power_off=False, recovery_mode=False, factory_reset=False, logger=No
 		os.remove(poweroff_file)
 
 	# Call reboot w/short delay
-	_reboot(delay, power_off, logger)
+	_reboot(delay, power_off, logger, host_commands)
 
 
-def _reboot(delay=1, power_off=False, logger=None):
+def _reboot(delay=1, power_off=False, logger=None, host_commands=None):
 
 	# These commands will cause SIGTERM to be sent to all running processes.
 	# The cleanup() function in Cme-init/__main__.py is a callback listening
@@ -105,11 +106,13 @@ def _reboot(delay=1, power_off=False, logger=None):
 	# delay - mostly for GPIO cleanup
 	time.sleep(delay)
 
-	# reboot system
+	# run any pending host commands and reboot system
+	# (continue past failures so the reboot always happens)
 	if is_a_cme():
+		results = run_batch((host_commands or []) + [ command ], stop_on_error=False)
 
-		if is_a_docker():
-			docker_run(command) 
-		else:
-			subprocess.call(command)
+		if logger:
+			for status, output in results:
+				if status != 0:
+					logger.error("CME host command failed ({0}): {1}".format(status, output))
 
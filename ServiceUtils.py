@@ -0,0 +1,140 @@
+''' systemd unit state and control, batched.
+
+	unit_states() reads the state of any number of units with a single
+	"systemctl show" (through the docker host when containerised) and keeps
+	the results for CACHE_s seconds; manage_units() enables, starts, stops,
+	disables or restarts many units in one run_batch() round trip, one
+	systemctl per verb.
+
+		from .common import ServiceUtils
+
+		if not ServiceUtils.is_active('ntp'):
+			ServiceUtils.manage_units(enable=['ntp'], start=['ntp'])
+
+	systemctl is found on PATH, so a stand-in script can replace it.
+'''
+import threading, time
+from collections import namedtuple
+
+from . import run_batch
+
+# unit_states() results are reused for this many seconds
+CACHE_s = 1.0
+
+PROPERTIES = ('Id', 'ActiveState', 'SubState', 'UnitFileState')
+
+SHOW_CMD = ['systemctl', 'show', '--property=' + ','.join(PROPERTIES)]
+
+
+class UnitState(namedtuple('UnitState', 'id active_state sub_state unit_file_state')):
+	''' A unit's state, e.g., ('ntp.service', 'active', 'running', 'enabled').
+	'''
+	__slots__ = ()
+
+	@property
+	def active(self):
+		return self.active_state == 'active'
+
+	@property
+	def enabled(self):
+		return self.unit_file_state == 'enabled'
+
+
+_states = {} # unit -> (monotonic time, UnitState)
+_states_lock = threading.Lock()
+
+
+def parse_show(output, units):
+	''' Returns the UnitStates of units from the output of SHOW_CMD + units
+		(one block of Key=Value lines per unit, in order, separated by
+		blank lines).
+	'''
+	blocks = [ {} ]
+
+	for line in output.splitlines():
+		if not line.strip():
+			if blocks[-1]:
+				blocks.append({})
+			continue
+
+		key, sep, value = line.partition('=')
+		if sep and key in PROPERTIES:
+			blocks[-1][key] = value.strip()
+
+	blocks = [ b for b in blocks if b ]
+
+	if len(blocks) != len(units):
+		raise ValueError('systemctl show returned {0} units for {1}'.format(len(blocks), len(units)))
+
+	return { unit: UnitState(b.get('Id', unit), b.get('ActiveState', ''), b.get('SubState', ''),
+		b.get('UnitFileState', '')) for unit, b in zip(units, blocks) }
+
+
+def unit_states(units, max_age=None):
+	''' Returns a dict of unit: UnitState.  Units not read in the last
+		max_age (CACHE_s by default) seconds are queried together.
+		Raises OSError if systemctl fails.
+	'''
+	max_age = CACHE_s if max_age is None else max_age
+	now = time.monotonic()
+
+	with _states_lock:
+		result = { u: _states[u][1] for u in units if u in _states and now - _states[u][0] <= max_age }
+
+	stale = [ u for u in units if u not in result ]
+
+	if stale:
+		status, output = run_batch([ SHOW_CMD + stale ])[0]
+		if status != 0:
+			raise OSError('systemctl show failed ({0}): {1}'.format(status, output))
+
+		fresh = parse_show(output, stale)
+		result.update(fresh)
+
+		with _states_lock:
+			for unit, state in fresh.items():
+				_states[unit] = (now, state)
+
+	return result
+
+
+def unit_state(unit, max_age=None):
+	return unit_states([ unit ], max_age)[unit]
+
+
+def is_active(unit, max_age=None):
+	return unit_state(unit, max_age).active
+
+
+def invalidate(units=None):
+	''' Forget the cached state of units (or of all of them).
+	'''
+	with _states_lock:
+		if units is None:
+			_states.clear()
+		else:
+			for unit in units:
+				_states.pop(unit, None)
+
+
+def manage_units(enable=(), start=(), stop=(), disable=(), restart=(), stop_on_error=False):
+	''' Change units with one systemctl per verb (stop, disable, enable,
+		start, then restart), all in one run_batch() round trip.  Returns
+		the (exit status, output) of each systemctl run.
+	'''
+	commands = []
+	units = set()
+
+	for verb, names in (('stop', stop), ('disable', disable), ('enable', enable),
+			('start', start), ('restart', restart)):
+		if names:
+			commands.append([ 'systemctl', verb ] + list(names))
+			units.update(names)
+
+	if not commands:
+		return []
+
+	try:
+		return run_batch(commands, stop_on_error=stop_on_error)
+	finally:
+		invalidate(units)
@@ -1,10 +1,12 @@
-import platform, os
+import os
 
 def is_a_cme():
 	''' Quick means to determine if we're on a cme device.  Many of
 		the system calls within util will not work unless we're on
 		a valid cme device platform.
 	'''
+	# platform is imported here, not at module level, as it is slow to import
+	import platform
 	return platform.node().startswith('cme')
 
 def is_a_docker():
@@ -16,11 +18,56 @@ def is_a_docker():
 FIFO_IN = '/tmp/cmehostinput'
 FIFO_OUT = '/tmp/cmehostoutput'
 
-def docker_run(command):
-	with open(FIFO_IN, 'w') as f:
-		f.write(' '.join(command) + '\n')
+# default limit (seconds) on a host command, so a missing or restarted
+# host can't hang the caller
+COMMAND_TIMEOUT_s = 60
 
-	with open(FIFO_OUT, 'r') as f:
-		result = f.read()
+def docker_run(command, timeout=COMMAND_TIMEOUT_s):
+	''' Run a command on the docker host over the host bridge FIFOs
+		(see HostBridge.py) and return its output.
+	'''
+	from .HostBridge import host_bridge
+
+	status, output = host_bridge().run(command, timeout)
+
+	return output.rstrip()
+
+
+def docker_run_batch(commands, stop_on_error=True, timeout=COMMAND_TIMEOUT_s):
+	''' Run an ordered list of commands on the docker host in a single
+		bridge round trip.  Returns a list of (exit status, output), one
+		per command run (see HostBridge.run_batch).
+	'''
+	from .HostBridge import host_bridge
+
+	return [ (status, output.rstrip()) for status, output in
+		host_bridge().run_batch(commands, stop_on_error, timeout) ]
+
+def run_batch(commands, stop_on_error=True, timeout=COMMAND_TIMEOUT_s):
+	''' Run an ordered list of system commands, through the docker host
+		if we're containerised, else directly.  Returns a list of
+		(exit status, output) for the commands run.  With stop_on_error
+		the first failing command ends the batch.  A local command that
+		runs over timeout seconds is killed and gets status 124.
+	'''
+	if is_a_docker():
+		return docker_run_batch(commands, stop_on_error, timeout)
+
+	import subprocess
+
+	results = []
+	for command in commands:
+		try:
+			result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+			status, output = result.returncode, result.stdout.decode(errors='replace').rstrip()
+		except subprocess.TimeoutExpired as e:
+			status, output = 124, str(e)
+		except OSError as e:
+			status, output = 127, str(e)
+
+		results.append((status, output))
+
+		if status != 0 and stop_on_error:
+			break
 
-	return result.rstrip()
\ No newline at end of file
+	return results
@@ -0,0 +1,111 @@
+''' asyncio counterparts of the blocking system probes in ClockUtils and IpUtils.
+
+	Each coroutine returns the same values as its blocking namesake but waits
+	on the host bridge (when inside a docker container) or an executor thread
+	so an event loop keeps running meanwhile:
+
+		from .common import aio
+		gw = await aio.gateway()
+		status = await aio.status_snapshot(settings['clock'])
+'''
+import asyncio
+
+from . import is_a_cme
+from . import ClockUtils, IpUtils
+from .HostBridge import host_bridge
+
+
+async def docker_run(command, timeout=None):
+	''' Run a command on the docker host and return its output.  The request
+		is written off the event loop and the reply is awaited, not read.
+	'''
+	loop = asyncio.get_event_loop()
+
+	future = await loop.run_in_executor(None, host_bridge().submit, { 'cmd': list(command) }, timeout)
+	reply = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+
+	return reply['output'].rstrip()
+
+
+async def check_ntp():
+	''' See ClockUtils.check_ntp.
+	'''
+	if not is_a_cme():
+		return True
+
+	poller = ClockUtils.ntp_poller()
+	if poller is not None and poller.time is not None:
+		return poller.active
+
+	loop = asyncio.get_event_loop()
+
+	return await loop.run_in_executor(None, ClockUtils._ntp_active)
+
+
+async def refresh_time(clock_settings):
+	''' See ClockUtils.refresh_time.
+	'''
+	loop = asyncio.get_event_loop()
+	servers = loop.run_in_executor(None, ClockUtils.ntp_servers)
+	poller = ClockUtils.ntp_poller()
+	age = 0
+
+	if clock_settings['ntp'] and is_a_cme():
+		if poller is not None and poller.time is not None:
+			clock_settings['status'] = list(poller.status)
+			age = poller.age
+		else:
+			peers = await loop.run_in_executor(None, ClockUtils.ntp_peers)
+			clock_settings['status'] = ClockUtils.peers_status(peers)
+	else:
+		clock_settings['status'] = [ '-', '-' ]
+
+	clock_settings['servers'] = await servers
+
+	return age
+
+
+async def address(iface=None):
+	''' See IpUtils.address (a cached snapshot, so it runs inline).
+	'''
+	return IpUtils.address(iface)
+
+
+async def netmask(iface=None):
+	''' See IpUtils.netmask (a cached snapshot, so it runs inline).
+	'''
+	return IpUtils.netmask(iface)
+
+
+async def gateway(iface=None):
+	''' See IpUtils.gateway (a cached snapshot, so it runs inline).
+	'''
+	return IpUtils.gateway(iface)
+
+
+async def status_snapshot(clock_settings=None):
+	''' Gather the network and clock status concurrently.  Returns
+
+			{ 'network': { 'mac', 'dhcp', 'address', 'netmask', 'gateway' },
+			  'clock': { <clock_settings>, 'active', 'status', 'servers' } }
+
+		clock_settings is copied, not updated.
+	'''
+	clock = dict(clock_settings or { 'ntp': True })
+	loop = asyncio.get_event_loop()
+
+	net, active, _ = await asyncio.gather(
+		loop.run_in_executor(None, IpUtils.network_snapshot), check_ntp(), refresh_time(clock))
+
+	clock['active'] = active
+
+	return {
+		'network': {
+			'mac': net.mac,
+			'dhcp': net.dhcp,
+			'address': net.address,
+			'netmask': net.netmask,
+			'gateway': net.gateway
+		},
+		'clock': clock
+	}
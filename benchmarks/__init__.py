@@ -0,0 +1,5 @@
+''' Micro-benchmarks for the Cme-common routines.  Run each one as a module
+	from the folder containing the package, e.g.,
+
+		$ python -m common.benchmarks.bench_host_bridge
+'''
@@ -0,0 +1,47 @@
+''' Import-time benchmark for Config.
+
+	Each run imports Config in a fresh interpreter (from a scratch folder
+	holding a VERSION file) and reports the import time alongside the time
+	to then resolve every lazy INFO/RECOVERY value - the work that used to
+	happen at import.
+'''
+import os, sys, subprocess, tempfile, shutil, statistics
+
+PACKAGE = __package__.rpartition('.')[0]
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PROBE = '''
+import sys, time
+sys.path.insert(0, {root!r})
+t0 = time.perf_counter()
+from {package} import Config
+t1 = time.perf_counter()
+Config.INFO.HOSTNAME, Config.INFO.SYSTEM, Config.INFO.VERSION, Config.INFO.DEVICE, Config.RECOVERY.RECOVERY_MODE
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t1)
+'''
+
+
+def main(runs=20):
+	tmpdir = tempfile.mkdtemp()
+	with open(os.path.join(tmpdir, 'VERSION'), 'w') as f:
+		f.write('0.0.0\n')
+
+	probe = PROBE.format(root=ROOT, package=PACKAGE)
+	imports, resolves = [], []
+
+	for _ in range(runs):
+		out = subprocess.run([ sys.executable, '-c', probe ], cwd=tmpdir,
+			stdout=subprocess.PIPE, check=True).stdout.decode().split()
+		imports.append(float(out[0]))
+		resolves.append(float(out[1]))
+
+	shutil.rmtree(tmpdir)
+
+	print('Config import over {0} fresh interpreters (median):'.format(runs))
+	print('  import:           {0:8.1f} us'.format(statistics.median(imports) * 1e6))
+	print('  resolve INFO etc: {0:8.1f} us (deferred until first access)'.format(statistics.median(resolves) * 1e6))
+
+
+if __name__ == '__main__':
+	main()
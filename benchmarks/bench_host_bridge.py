@@ -0,0 +1,53 @@
+''' Load test of the host command bridge against a local HostServer stand-in.
+
+	Several threads issue commands concurrently over one bridge and every
+	reply is checked against the command that requested it.
+'''
+import os, sys, time, tempfile, threading, shutil
+
+from ..HostBridge import HostBridge, HostServer
+
+
+def echo_runner(command):
+	return 0, ' '.join(command[1:]) + '\n'
+
+
+def main(threads=8, requests=500):
+	tmpdir = tempfile.mkdtemp()
+	fifo_in = os.path.join(tmpdir, 'hostinput')
+	fifo_out = os.path.join(tmpdir, 'hostoutput')
+
+	server = HostServer(fifo_in, workers=4, runner=echo_runner, fifo_out=fifo_out).start()
+	bridge = HostBridge(fifo_in, fifo_out)
+	errors = []
+
+	def worker(n):
+		for i in range(requests):
+			token = '{0}-{1}'.format(n, i)
+			status, output = bridge.run(['echo', token], timeout=10)
+			if status != 0 or output.rstrip() != token:
+				errors.append((token, output))
+
+	workers = [ threading.Thread(target=worker, args=(n,)) for n in range(threads) ]
+
+	start = time.perf_counter()
+	for w in workers:
+		w.start()
+	for w in workers:
+		w.join()
+	elapsed = time.perf_counter() - start
+
+	bridge.close()
+	server.stop()
+	shutil.rmtree(tmpdir)
+
+	total = threads * requests
+	print('{0} requests from {1} threads in {2:.3f} s'.format(total, threads, elapsed))
+	print('  {0:.1f} us/request, {1:.0f} requests/s'.format(elapsed / total * 1e6, total / elapsed))
+	print('  mismatched replies: {0}'.format(len(errors)))
+
+	return 1 if errors else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,49 @@
+''' Per-call logging latency as seen by the caller (e.g., the Cme-hw
+	polling loop), for the default synchronous handlers and ASYNC mode.
+'''
+import os, time, tempfile, shutil, statistics
+
+from .. import Logging
+
+
+def run(name, config, calls):
+	logger = Logging.GetLogger(name, config)
+	times = []
+
+	for i in range(calls):
+		start = time.perf_counter()
+		logger.info('sensor ch%d:s%d reading %.3f', i % 16, i % 4, i * 0.001)
+		times.append(time.perf_counter() - start)
+
+	Logging.Shutdown()
+
+	times.sort()
+	return statistics.mean(times), times[int(len(times) * 0.99)], max(times)
+
+
+def main(calls=20000):
+	tmpdir = tempfile.mkdtemp()
+
+	base = {
+		'REMOVE_PREVIOUS': True,
+		'SIZE': 1024 * 50,
+		'COUNT': 1,
+		'FORMAT': '%(asctime)s %(levelname)-8s [%(name)s] %(message)s',
+		'DATE': '%Y-%m-%d %H:%M:%S',
+		'LEVEL': 'DEBUG',
+		'CONSOLE': False
+	}
+
+	print('{0} log calls, latency per call (us):'.format(calls))
+	print('  {0:8} {1:>10} {2:>10} {3:>10}'.format('mode', 'mean', 'p99', 'max'))
+
+	for mode, extra in (('sync', {}), ('async', { 'ASYNC': True, 'QUEUE_SIZE': calls })):
+		config = dict(base, PATH=os.path.join(tmpdir, mode + '.log'), **extra)
+		mean, p99, worst = run('bench.' + mode, config, calls)
+		print('  {0:8} {1:10.1f} {2:10.1f} {3:10.1f}'.format(mode, mean * 1e6, p99 * 1e6, worst * 1e6))
+
+	shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+	main()
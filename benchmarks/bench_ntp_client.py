@@ -0,0 +1,34 @@
+''' Native NTP client benchmark.
+
+	Queries the stand-in ntpd (ntp_standin) with NtpClient, checks the peers
+	against the ntpq table the stand-in represents, and times a peer query
+	and an SNTP probe (compare with forking "ntpq -pn", several ms on a Pi).
+'''
+import timeit
+
+from .. import NtpClient
+from ..ClockUtils import sync_peer
+from .ntp_standin import StandIn
+
+
+def main(number=500):
+	with StandIn() as server:
+		peers = NtpClient.peers(port=server.port)
+
+		assert [ p.tally for p in peers ] == [ '*', '+', ' ' ], peers
+		assert sync_peer(peers).remote == '192.168.1.10'
+		assert peers[0].when in (37, 38) and peers[0].poll == 64 and peers[0].reach == 0xff
+		assert peers[2].when is None and peers[2].stratum == 16
+
+		probe = NtpClient.sntp_offset('127.0.0.1', port=server.port)
+		assert abs(probe.offset - server.offset) < 0.01, probe
+
+		query = min(timeit.repeat(lambda: NtpClient.peers(port=server.port), number=number, repeat=3)) / number
+		sntp = min(timeit.repeat(lambda: NtpClient.sntp_offset('127.0.0.1', port=server.port), number=number, repeat=3)) / number
+
+	print('  {0:24} {1:10.1f} us'.format('peers() (3 peers)', query * 1e6))
+	print('  {0:24} {1:10.1f} us'.format('sntp_offset()', sntp * 1e6))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,29 @@
+''' ntpq peer table parser benchmark.
+
+	Checks ClockUtils.parse_ntpq() against the captured outputs in
+	ntpq_corpus and times it (and ntp_status()) on each of them.
+'''
+import timeit
+
+from ..ClockUtils import parse_ntpq, sync_peer, ntp_status
+from .ntpq_corpus import CORPUS
+
+
+def main(number=20000):
+	print('  {0:10} {1:>6} {2:>16} {3:>16}'.format('output', 'peers', 'parse_ntpq (us)', 'ntp_status (us)'))
+
+	for name, output, count, remote in CORPUS:
+		peers = parse_ntpq(output)
+		peer = sync_peer(peers)
+
+		assert len(peers) == count, (name, peers)
+		assert (peer and peer.remote) == remote, (name, peer)
+
+		parse = min(timeit.repeat(lambda: parse_ntpq(output), number=number, repeat=3)) / number
+		status = min(timeit.repeat(lambda: ntp_status(output), number=number, repeat=3)) / number
+
+		print('  {0:10} {1:6d} {2:16.2f} {3:16.2f}'.format(name, count, parse * 1e6, status * 1e6))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,68 @@
+''' DictPersistJSON serializer benchmark.
+
+	Compares dump and load latency and file size of each serializer for a
+	typical settings.json payload and a larger channel configuration
+	payload (as kept under PATHS.CHDIR).
+'''
+import os, time, tempfile, shutil, random
+
+from ..DictPersistJSON import DictPersistJSON, SERIALIZERS
+
+
+def settings_payload():
+	return {
+		'clock': { 'ntp': True, 'servers': [ 'time.nist.gov', '0.pool.ntp.org' ], 'status': [ '-', '-' ],
+			'zone': -6, 'displayRelativeTo': 1, 'display12HourTime': False },
+		'network': { 'mac': '00:12:34:AB:CD:EF', 'dhcp': False, 'address': '192.168.1.30',
+			'netmask': '255.255.255.0', 'gateway': '192.168.1.1', 'primary': '8.8.4.4', 'secondary': '8.8.8.8' },
+		'temperature': { 'displayUnits': 0, 'warning': 65, 'alarm': 80 },
+		'snmp': { 'enabled': False, 'community': 'public' }
+	}
+
+
+def channel_payload(channels=16, sensors=4, points=120):
+	rnd = random.Random(1)
+	return {
+		'ch{0}'.format(c): {
+			'id': 'ch{0}'.format(c), 'name': 'Channel {0}'.format(c), 'description': 'Surge protector',
+			'sensors': {
+				's{0}'.format(s): {
+					'id': 's{0}'.format(s), 'type': 'AC_VOLTAGE', 'unit': 'Vrms', 'range': [ 0.0, 300.0 ],
+					'thresholds': [ { 'value': 250.0, 'direction': 'MAX', 'classification': 'ALARM' } ],
+					'data': [ [ 1494000000 + i, rnd.uniform(110.0, 130.0) ] for i in range(points) ]
+				} for s in range(sensors)
+			}
+		} for c in range(channels)
+	}
+
+
+def measure(fn, repeat):
+	best = float('inf')
+	for _ in range(repeat):
+		start = time.perf_counter()
+		fn()
+		best = min(best, time.perf_counter() - start)
+	return best
+
+
+def main(repeat=20):
+	tmpdir = tempfile.mkdtemp()
+
+	for label, payload in (('settings', settings_payload()), ('channels', channel_payload())):
+		print('{0} payload:'.format(label))
+		print('  {0:14} {1:>12} {2:>12} {3:>10}'.format('serializer', 'dump (ms)', 'load (ms)', 'bytes'))
+
+		for name in SERIALIZERS:
+			filename = os.path.join(tmpdir, '{0}.{1}'.format(label, name))
+			store = DictPersistJSON(filename, payload, serializer=name)
+
+			dump = measure(store._dump, repeat)
+			load = measure(store._read, repeat)
+
+			print('  {0:14} {1:12.3f} {2:12.3f} {3:10d}'.format(name, dump * 1e3, load * 1e3, os.path.getsize(filename)))
+
+	shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+	main()
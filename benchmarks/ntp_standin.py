@@ -0,0 +1,87 @@
+''' A stand-in ntpd on 127.0.0.1 for exercising NtpClient: it answers mode 6
+	READSTAT/READVAR requests from a table of peers (in small fragments, to
+	exercise reassembly) and SNTP client requests with a fixed clock offset.
+
+		with StandIn() as server:
+			peers = NtpClient.peers(port=server.port)
+'''
+import socket, struct, threading, time
+
+from ..NtpClient import _CONTROL, _SNTP, _ntp_time, NTP_DELTA, \
+	CTL_OP_READSTAT, CTL_RESPONSE, CTL_MORE
+
+
+def _peer_vars(srcadr, refid, stratum, reach, poll, delay, offset, jitter, ago):
+	rec = int(time.time() + NTP_DELTA - ago)
+	return ('srcadr={0}, srcport=123, refid={1}, stratum={2}, hmode=3, '
+		'hpoll={3}, ppoll={3}, reach=0x{4:02x}, rec=0x{5:08x}.00000000, '
+		'delay={6:.3f}, offset={7:.3f}, jitter={8:.3f}, filtdelay="{6:.2f} {6:.2f}"').format(
+			srcadr, refid, stratum, poll, reach, rec, delay, offset, jitter).encode()
+
+
+# association id -> (status word, variables); status bits 8-10 select the tally
+PEERS = {
+	101: (0x9614, _peer_vars('192.168.1.10', '.GPS.', 1, 0xff, 6, 0.512, -0.032, 0.021, 37)),
+	102: (0x9414, _peer_vars('129.6.15.28', '.NIST.', 1, 0xfe, 6, 38.12, 1.204, 0.833, 12)),
+	103: (0x8011, _peer_vars('10.0.0.3', '.INIT.', 16, 0x00, 10, 0.0, 0.0, 0.0, 0))
+}
+
+
+class StandIn(object):
+	FRAGMENT = 64 # bytes of data per response packet
+
+	def __init__(self, peers=PEERS, offset=0.25):
+		self.peers = peers
+		self.offset = offset
+		self.requests = 0
+
+		self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self._sock.bind(('127.0.0.1', 0))
+		self.port = self._sock.getsockname()[1]
+		self._thread = threading.Thread(target=self._serve, daemon=True)
+
+	def __enter__(self):
+		self._thread.start()
+		return self
+
+	def __exit__(self, _exc_type, _exc_value, _traceback):
+		self._sock.sendto(b'stop', ('127.0.0.1', self.port))
+		self._thread.join()
+		self._sock.close()
+
+	def _serve(self):
+		while True:
+			packet, client = self._sock.recvfrom(1024)
+			if packet == b'stop':
+				return
+
+			self.requests += 1
+
+			if packet[0] & 7 == 6:
+				self._control(packet, client)
+			elif packet[0] & 7 == 3:
+				self._sntp(packet, client)
+
+	def _control(self, packet, client):
+		_, opcode, sequence, _, association, _, _ = _CONTROL.unpack_from(packet)
+
+		if opcode == CTL_OP_READSTAT:
+			data = b''.join(struct.pack('!HH', a, p[0]) for a, p in sorted(self.peers.items()))
+		else:
+			data = self.peers[association][1]
+
+		# send the fragments last first, the client must reorder them
+		fragments = list(range(0, len(data), self.FRAGMENT)) or [ 0 ]
+		for offset in reversed(fragments):
+			chunk = data[offset:offset + self.FRAGMENT]
+			flags = CTL_RESPONSE | opcode | (CTL_MORE if offset + len(chunk) < len(data) else 0)
+
+			reply = _CONTROL.pack(packet[0], flags, sequence, 0, association, offset, len(chunk)) + chunk
+			self._sock.sendto(reply + b'\x00' * (-len(reply) % 4), client)
+
+	def _sntp(self, packet, client):
+		transmit = _SNTP.unpack_from(packet)[-1]
+		now = _ntp_time(time.time() + self.offset)
+
+		reply = _SNTP.pack((4 << 3) | 4, 2, 6, -20, 0, 0, b'GPS\x00', now, transmit, now, now)
+		self._sock.sendto(reply, client)
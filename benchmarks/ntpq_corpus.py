@@ -0,0 +1,49 @@
+''' Captured "ntpq -pn" outputs, with the number of peers and the sync peer
+	(remote) parse_ntpq() and sync_peer() should find in each.
+'''
+
+SYNCED = '''\
+     remote           refid      st t when poll reach   delay   offset  jitter
+==============================================================================
+*192.168.1.10    .GPS.            1 u   37   64  377    0.512   -0.032   0.021
++129.6.15.28     .NIST.           1 u   12   64  377   38.120    1.204   0.833
+-132.163.97.1    .NIST.           1 u   50   64  376   41.300    2.918   1.100
+ 127.127.1.0     .LOCL.          10 l  45m   64    0    0.000    0.000   0.000
+'''
+
+UNITS = '''\
+     remote           refid      st t when poll reach   delay   offset  jitter
+==============================================================================
+*10.0.0.1        193.190.230.65   2 u  12m 1024  377    1.210    0.104   0.088
++10.0.0.2        162.159.200.1    3 u   3h 1024  177    1.455   -0.311   0.250
+ 10.0.0.3        .INIT.          16 u    - 1024    0    0.000    0.000   0.000
+#10.0.0.4        216.239.35.4     2 u   2d   17m  1      2.002    4.800   3.112
+'''
+
+STARTING = '''\
+     remote           refid      st t when poll reach   delay   offset  jitter
+==============================================================================
+ 0.pool.ntp.org  .POOL.          16 p    -   64    0    0.000    0.000   0.000
+ 192.168.1.10    .INIT.          16 u    -   64    0    0.000    0.000   0.000
+'''
+
+NO_PEERS = '''\
+No association ID's returned
+'''
+
+IPV6 = '''\
+     remote           refid      st t when poll reach   delay   offset  jitter
+==============================================================================
+*2001:db8::123
+                 .GPS.            1 u   40  128  377    0.823    0.014   0.005
++192.168.1.11    192.168.1.10     2 u   98  128  377    0.601    0.020   0.009
+'''
+
+# (name, output, peers, sync peer)
+CORPUS = [
+	('synced', SYNCED, 4, '192.168.1.10'),
+	('units', UNITS, 4, '10.0.0.1'),
+	('starting', STARTING, 2, '0.pool.ntp.org'),
+	('no_peers', NO_PEERS, 0, None),
+	('ipv6', IPV6, 2, '2001:db8::123')
+]